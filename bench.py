@@ -0,0 +1,161 @@
+import asyncio
+import compute
+import json
+import os
+import re
+import sys
+
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+from database import Database
+from extract import extract_text
+from render import Renderer
+from utils import to_html, tokenize
+
+# Usage: python bench.py <name> [args...]
+
+
+def timeit(func, repeat: int = 5) -> float:
+    results = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        results.append(perf_counter() - start)
+    return median(results)
+
+
+def fake_chats(count: int, messages: int = 4, owners: int = 100) -> list:
+    return [{
+        "uid": i, "owner": i % owners, "title": f"Chat #{i}", "created_at": 0, "last_accessed": i,
+        "messages": [{"role": "user" if j % 2 else "assistant", "content": "Lorem ipsum dolor sit amet " * 20} for j in range(messages)]
+    } for i in range(count)]
+
+
+def bench_commit(*sizes: str) -> None:
+    """Full snapshot rewrite (the old per-message commit) vs one appended log record"""
+    for size in map(int, sizes or (100, 10_000, 100_000)):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "messages.json")
+            with open(path, "w") as f:
+                json.dump({"users": [], "chats": fake_chats(size)}, f)
+            db = Database(path, compact_after=10**9)
+            rewrite = timeit(db.commit, 3)
+            append = timeit(lambda: db.create_message(0, "user", content="Hello there"), 100)
+            print(f"{size:>7} chats: rewrite {rewrite * 1000:9.2f}ms, append {append * 1000:7.3f}ms ({rewrite / append:,.0f}x)")
+
+
+def bench_lookup(*sizes: str) -> None:
+    """Per-call latency of the indexed lookups (10 chats per owner), should stay flat as the chat count grows"""
+    for size in map(int, sizes or (1_000, 10_000, 100_000, 1_000_000)):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "messages.json")
+            with open(path, "w") as f:
+                json.dump({"users": [{"uid": i, "model": "gpt-3.5-turbo", "has_gpt4": False} for i in range(100)],
+                           "chats": fake_chats(size, messages=0, owners=size // 10)}, f)
+            db = Database(path, compact_after=10**9)
+            calls = {
+                "get_chat": lambda: db.get_chat(size // 2),
+                "get_user": lambda: db.get_user(50),
+                "get_chats": lambda: db.get_chats(50)[:5],
+                "create_message": lambda: db.create_message(size // 2, "user", content="Hello there"),
+                "create_chat": lambda: db.create_chat("Benchmark", 50)
+            }
+            stats = ", ".join(f"{name} {timeit(func, 100) * 10**6:.1f}us" for name, func in calls.items())
+            print(f"{size:>9} chats: {stats}")
+
+
+def legacy_extract(body: bytes) -> str:
+    soup = BeautifulSoup(body.decode(errors="replace"), features="html.parser")
+    for script in soup(["script", "style", "head"]):
+        script.extract()
+    text = soup.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    phrases = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return "\n".join(phrase for phrase in phrases if phrase)
+
+
+def bench_extract(corpus: str) -> None:
+    """Old BeautifulSoup pipeline vs extract_text over a directory of saved .html pages"""
+    for name in sorted(os.listdir(corpus)):
+        if not name.endswith((".html", ".htm")):
+            continue
+        with open(os.path.join(corpus, name), "rb") as f:
+            body = f.read()
+        legacy = timeit(lambda: legacy_extract(body), 3)
+        new = timeit(lambda: extract_text(body), 3)
+        print(f"{name[:40]:<40} {len(body) // 1024:>6} KiB: legacy {legacy * 1000:8.1f}ms, extract_text {new * 1000:8.1f}ms ({legacy / new:.1f}x)")
+
+
+def bench_lag(users: str = "8", size: str = "200000") -> None:
+    """Event loop lag while N handlers tokenize a page concurrently, inline vs through the compute pool"""
+    text = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (int(size) // 10)
+
+    async def inline():
+        return tokenize(text)
+
+    async def pooled():
+        return await compute.atokenize(text)
+
+    async def measure(handler) -> None:
+        monitor = compute.LagMonitor(interval=0.01, warn=float("inf"))
+        monitor.start()
+        start = perf_counter()
+        await asyncio.gather(*(handler() for _ in range(int(users))))
+        total = perf_counter() - start
+        await asyncio.sleep(0.05)
+        monitor.stop()
+        print(f"{handler.__name__:>6}: {total:.2f}s total, loop lag max {monitor.max * 1000:.0f}ms, mean {monitor.mean * 1000:.1f}ms")
+
+    asyncio.run(measure(inline))
+    asyncio.run(measure(pooled))
+
+
+def legacy_to_html(markdown_text: str) -> str:
+    html_text = markdown_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    html_text = re.sub(r"\*\*\*(.*?)\*\*\*", r"<b><i>\1</i></b>", html_text)
+    html_text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", html_text)
+    html_text = re.sub(r"\*(.*?)\*", r"<i>\1</i>", html_text)
+    html_text = re.sub(r"```(\w+)?\n(.*?)\n```", lambda m: f"<pre><code class='language-{m.group(1) or ''}'>{m.group(2)}</code></pre>", html_text, flags=re.DOTALL)
+    html_text = re.sub(r"`(.*?)`", r"<code>\1</code>", html_text)
+    html_text = re.sub(r"^> (.*?)$", r"<blockquote>\1</blockquote>", html_text, flags=re.MULTILINE)
+    html_text = re.sub(r"\[(.*?)\]\((.*?)\)", r"<a href='\2'>\1</a>", html_text)
+    for escaped in ["[", "]", "(", ")", "{", "}", "<", ">", "#", "*", "_", "+", "-", "=", "\\", "|", ".", "!"]:
+        html_text = html_text.replace("\\" + escaped, escaped)
+    return html_text
+
+
+def bench_render(paragraphs: str = "200", step: str = "40") -> None:
+    """Old regex to_html vs the renderer, once on a full answer and on every edit of a streamed one"""
+    paragraph = "Some **bold** text, *italic* and `code` with a [link](https://example.com). " * 3
+    code = "```python\nfor i in range(10):\n    print(i * 2)\n```"
+    text = "\n".join(code if i % 10 == 9 else paragraph for i in range(int(paragraphs)))
+    prefixes = [text[:i] for i in range(0, len(text), int(step))] + [text]
+    print(f"{len(text)} characters, {len(prefixes)} streamed edits")
+    print(f"  full: legacy {timeit(lambda: legacy_to_html(text)) * 1000:8.2f}ms, renderer {timeit(lambda: to_html(text)) * 1000:8.2f}ms")
+
+    def incremental():
+        renderer = Renderer()
+        for prefix in prefixes:
+            renderer.render(prefix)
+
+    legacy = timeit(lambda: [legacy_to_html(p) for p in prefixes], 3)
+    print(f"stream: legacy {legacy * 1000:8.2f}ms, incremental {timeit(incremental, 3) * 1000:8.2f}ms")
+
+
+benchmarks = {
+    "commit": bench_commit,
+    "lookup": bench_lookup,
+    "extract": bench_extract,
+    "lag": bench_lag,
+    "render": bench_render
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"Available: {', '.join(benchmarks.keys())}")
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,85 @@
+import base64
+import compute
+import hashlib
+import imghdr
+import os
+import tempfile
+
+from collections import OrderedDict
+from os.path import exists, join
+
+from const import config
+
+prefix = "blob:"
+
+
+def data_url(file: str) -> str:
+    """Reads a blob and encodes it as a data URL. Blocking, run it in the compute pool"""
+    with open(file, "rb") as f:
+        data = f.read()
+    return f"data:image/{imghdr.what(None, data) or 'jpeg'};base64,{str(base64.b64encode(data), encoding='utf8')}"
+
+
+class BlobStore:
+    """Content-addressed files: `<path>/<2 chars>/<sha256>`. Equal uploads are stored once,
+    messages keep only the `blob:<sha256>` reference"""
+
+    def __init__(self, path: str = "blobs", cached_urls: int = 32) -> None:
+        self.path = path
+        self.cached_urls = cached_urls
+        self.urls: OrderedDict[str, str] = OrderedDict()  # reference -> data URL, least recently used first
+        os.makedirs(path, exist_ok=True)
+
+
+    def _file(self, digest: str) -> str:
+        return join(self.path, digest[:2], digest)
+
+
+    def put(self, data: bytes) -> str:
+        """Stores `data` and returns its reference. Blocking, run it in the compute pool"""
+        digest = hashlib.sha256(data).hexdigest()
+        file = self._file(digest)
+        if not exists(file):
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            # A temp file per writer, concurrent puts of the same data must not share one
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(file), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp, file)
+            except BaseException:
+                os.remove(temp)
+                raise
+        return prefix + digest
+
+
+    def get(self, reference: str) -> bytes:
+        with open(self._file(reference.removeprefix(prefix)), "rb") as f:
+            return f.read()
+
+
+    async def adata_url(self, reference: str) -> str:
+        if reference in self.urls:
+            self.urls.move_to_end(reference)
+            return self.urls[reference]
+        url = await compute.run(data_url, self._file(reference.removeprefix(prefix)))
+        self.urls[reference] = url
+        while len(self.urls) > self.cached_urls:
+            self.urls.popitem(last=False)
+        return url
+
+
+blobs = BlobStore(config.get("blob_path", "blobs"))
+
+
+async def amaterialize(payload: dict) -> dict:
+    """Replaces blob references in the image parts of a message payload with data URLs, right before it is sent.
+    Files are read and encoded in the compute pool"""
+    if not isinstance(payload.get("content"), list):
+        return payload
+    content = []
+    for part in payload["content"]:
+        if part.get("type") == "image_url" and part["image_url"]["url"].startswith(prefix):
+            part = {**part, "image_url": {**part["image_url"], "url": await blobs.adata_url(part["image_url"]["url"])}}
+        content.append(part)
+    return {**payload, "content": content}
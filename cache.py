@@ -0,0 +1,187 @@
+import asyncio
+import compute
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+
+from collections import OrderedDict
+from functools import wraps
+from os.path import join
+from time import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from const import config, log
+
+
+def write_entry(file: str, key: str, value: str, expires: float) -> None:
+    """Writes one entry atomically, its mtime is set to the expiry so sweep() needs no reading"""
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(file), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"key": key, "expires": expires, "value": value}, f)
+        os.utime(temp, (expires, expires))
+        os.replace(temp, file)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def sweep(path: str) -> int:
+    """Deletes expired entry files, returns how many"""
+    removed = 0
+    now = time()
+    for entry in os.scandir(path):
+        try:
+            if entry.name.endswith(".json") and entry.stat().st_mtime < now:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:  # removed by a concurrent read
+            pass
+    return removed
+
+
+def read_entry(file: str, key: str) -> Optional[Tuple[float, str]]:
+    """Expiry and value of a persisted entry. An expired file is deleted"""
+    try:
+        with open(file) as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):  # missing, or half written by an older version
+        return None
+    if data["key"] != key:
+        return None
+    if data["expires"] < time():
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        return None
+    return data["expires"], data["value"]
+
+
+class Cache:
+    """TTL + LRU cache of strings bounded by their total size in bytes.
+    With `path` set, entries are also written there (in the compute pool) and survive restarts.
+    Expired files are deleted when read, on startup and every `sweep_every` writes"""
+
+    def __init__(self, max_bytes: int = 64 * 2**20, path: Optional[str] = None, sweep_every: int = 1000) -> None:
+        self.max_bytes = max_bytes
+        self.path = path
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.sweep_every = sweep_every
+        self.writes = 0
+        self.entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self.pending: Dict[str, asyncio.Future] = {}
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            sweep(path)
+
+
+    def _file(self, key: str) -> str:
+        return join(self.path, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+
+    def _insert(self, key: str, expires: float, value: str) -> None:
+        self._remove(key)
+        self.entries[key] = (expires, value)
+        self.size += len(value.encode())
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+
+
+    def _remove(self, key: str) -> None:
+        if (entry := self.entries.pop(key, None)) is not None:
+            self.size -= len(entry[1].encode())
+
+
+    def get(self, key: str) -> Optional[str]:
+        """Memory only, see aget() for the persisted entries"""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+
+    async def aget(self, key: str) -> Optional[str]:
+        """Memory, then the file of the entry (read in the compute pool)"""
+        if (value := self.get(key)) is not None or self.path is None:
+            return value
+        if (entry := await compute.run(read_entry, self._file(key), key)) is None:
+            return None
+        self._insert(key, *entry)
+        return entry[1]
+
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        expires = time() + ttl
+        self._insert(key, expires, value)
+        if self.path is not None:
+            await compute.run(write_entry, self._file(key), key, value, expires)
+            self.writes += 1
+            if self.writes % self.sweep_every == 0:
+                if removed := await compute.run(sweep, self.path):
+                    log.info(f"Cache: deleted [bold]{removed}[/] expired files")
+
+
+    async def fetch(self, name: str, key: str, ttl: float, func: Callable[[], Awaitable[str]]) -> str:
+        """Returns the cached value or awaits `func` once, concurrent callers of the same key share the call
+        (and the disk lookup before it)"""
+        if (value := self.get(key)) is not None:
+            self._hit(name)
+            return value
+        if key in self.pending:
+            self.hits += 1
+        else:
+            self.pending[key] = asyncio.ensure_future(self._load(name, key, ttl, func))
+        # Shielded, so a caller timing out does not cancel the call for the others (or for the cache)
+        return await asyncio.shield(self.pending[key])
+
+
+    def _hit(self, name: str) -> None:
+        self.hits += 1
+        log.info(f"Cache hit for [bold]{name}[/] ({self.hits} hits, {self.misses} misses, {self.size // 1024} KiB)")
+
+
+    async def _load(self, name: str, key: str, ttl: float, func: Callable[[], Awaitable[str]]) -> str:
+        try:
+            if (value := await self.aget(key)) is not None:
+                self._hit(name)
+                return value
+            self.misses += 1
+            value = await func()
+            await self.set(key, value, ttl)
+            return value
+        finally:
+            del self.pending[key]
+
+
+cache = Cache(config.get("cache_bytes", 64 * 2**20), config.get("cache_path"))
+
+
+def normalize(value):
+    if isinstance(value, str):
+        return " ".join(value.split())
+    return value
+
+
+def cached(name: str):
+    """Caches a tool by its normalized arguments (defaults applied, whitespace collapsed) for `cache_ttl[name]` seconds"""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            ttl = config.get("cache_ttl", {}).get(name)
+            if not ttl:
+                return await func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = json.dumps([name, {k: normalize(v) for k, v in bound.arguments.items()}], sort_keys=True)
+            return await cache.fetch(name, key, ttl, lambda: func(*args, **kwargs))
+        return wrapper
+    return decorator
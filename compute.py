@@ -0,0 +1,95 @@
+import asyncio
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+from typing import AsyncIterator, Iterator, List
+
+from const import config, log
+from metrics import loop_lag
+from utils import message_tokens, to_html, tokenize, total_tokens
+
+
+def create_executor(kind: str = "thread", workers: int = None) -> Executor:
+    if kind == "process":
+        return ProcessPoolExecutor(workers)
+    return ThreadPoolExecutor(workers, thread_name_prefix="compute")
+
+
+executor = create_executor(config.get("compute_pool", "thread"), config.get("compute_workers"))
+
+
+async def run(func, *args, **kwargs):
+    """Runs blocking `func` in the compute pool. With a process pool `func` and arguments must be picklable"""
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+async def iterate(iterator: Iterator) -> AsyncIterator:
+    """Steps a blocking iterator in a thread and yields every item as soon as it is ready.
+    Always a thread, generators can't be sent to a process pool"""
+    done = object()
+    while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield item
+
+
+async def atokenize(text: str) -> List[int]:
+    return await run(tokenize, text)
+
+
+async def atotal_tokens(text: str) -> int:
+    return await run(total_tokens, text)
+
+
+async def amessage_tokens(message: dict) -> int:
+    return await run(message_tokens, message)
+
+
+async def ato_html(markdown_text: str) -> str:
+    return await run(to_html, markdown_text)
+
+
+class LagMonitor:
+    """Measures how late the event loop wakes up from a sleep, i.e. how long handlers block it"""
+
+    def __init__(self, interval: float = 0.25, warn: float = 0.2) -> None:
+        self.interval = interval
+        self.warn = warn
+        self.task = None
+        self.reset()
+
+
+    def reset(self) -> None:
+        self.max = 0.0
+        self.total = 0.0
+        self.samples = 0
+
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.samples if self.samples else 0.0
+
+
+    async def run(self) -> None:
+        while True:
+            start = monotonic()
+            await asyncio.sleep(self.interval)
+            lag = monotonic() - start - self.interval
+            self.max = max(self.max, lag)
+            self.total += lag
+            self.samples += 1
+            loop_lag.observe(lag)
+            if lag > self.warn:
+                log.warn(f"Event loop was blocked for [bold]{lag:.2f}s[/]")
+
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+
+lag = LagMonitor(warn=config.get("loop_lag_warn", 0.2))
@@ -2,7 +2,7 @@ from logger import Logger
 from yaml import load, Loader
 
 config = load(open("config.yml"), Loader=Loader)
-log = Logger()
+log = Logger(level=config.get("log_level", "debug"), json_path=config.get("log_json"), dedupe_seconds=config.get("log_dedupe_seconds", 10))
 
 supported_images = ("jpeg", "png", "gif", "webp")
 
@@ -22,6 +22,12 @@ pricing = {
     "gpt-4-turbo": [0.01, 0.03],
 }
 
+# model -> context window in tokens
+context_windows = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4-turbo": 128000,
+}
+
 headers = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36 OPR/107.0.0.0"
 }
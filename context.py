@@ -0,0 +1,85 @@
+import compute
+import json
+
+from typing import List, Tuple
+
+from blobs import amaterialize
+from const import config, context_windows, log, pricing
+from database import Message
+from funcs import functions
+from utils import detokenize, tokenize
+
+tools_tokens = len(tokenize(json.dumps(functions)))
+
+
+def context_budget(model: str, reserve: int = 2048) -> int:
+    """Prompt tokens available for the history: context window minus the completion and tool definitions,
+    optionally capped by `context_price` (max $ per request, converted with the model's input price)"""
+    budget = context_windows[model] - reserve - tools_tokens
+    if price := config.get("context_price"):
+        budget = min(budget, int(price * 1000 / pricing[model][0]))
+    return budget
+
+
+def group_messages(messages: List[Message]) -> List[List[Message]]:
+    """Splits the history into units that can only be kept or dropped together (assistant tool_calls + tool results)"""
+    units = []
+    for message in messages:
+        if message.role == "tool" and len(units) > 0 and units[-1][0].get("tool_calls"):
+            units[-1].append(message)
+        else:
+            units.append([message])
+    return units
+
+
+async def trim_tool(message: Message, limit: int) -> Message:
+    if message.tokens <= limit:  # the stored count covers the content, most results need no tokenizing
+        return message
+    # Only large results get here, they are cut in the compute pool
+    tokens = await compute.atokenize(message.content or "")
+    if len(tokens) <= limit:
+        return message
+    return Message("tool", await compute.run(detokenize, tokens[:limit]) + "\n[...truncated]", tool_call_id=message["tool_call_id"], name=message["name"])
+
+
+async def fit_tools(units: List[List[Message]], room: int) -> List[List[Message]]:
+    """Cuts the tool results of the units so that they fit into `room` tokens together with the other messages.
+    Smaller results are kept whole and whatever they leave is shared equally by the larger ones"""
+    results = sorted(((i, j) for i, unit in enumerate(units) for j in range(1, len(unit))), key=lambda p: units[p[0]][p[1]].tokens)
+    room -= sum(m.tokens for unit in units for m in unit) - sum(units[i][j].tokens for i, j in results)
+    units = [list(unit) for unit in units]
+    for n, (i, j) in enumerate(results):
+        share = max(0, room) // (len(results) - n)
+        if units[i][j].tokens > share:
+            units[i][j] = await trim_tool(units[i][j], max(1, share - 16))  # role, name and the truncation note
+        room -= units[i][j].tokens
+    return units
+
+
+async def build_context(messages: List[Message], model: str, reserve: int = 2048) -> Tuple[List[dict], int]:
+    """Fits the history into the model's budget. System messages and the current turn (from the last user message)
+    are always kept, tool results of the current turn are cut only if it doesn't fit otherwise. Tool results of older
+    turns are cut to `context_tool_tokens` and then the oldest units are dropped.
+    Returns the messages ready to be sent and their approximate size in tokens"""
+    budget = context_budget(model, reserve)
+    system = [m for m in messages if m.role == "system"]
+    units = group_messages([m for m in messages if m.role != "system"])
+    last_user = max((i for i, unit in enumerate(units) if unit[0].role == "user"), default=0)
+    used = sum(m.tokens for m in system)
+    kept = units[last_user:]
+    if used + sum(m.tokens for unit in kept for m in unit) > budget:
+        kept = await fit_tools(kept, budget - used)
+    used += sum(m.tokens for unit in kept for m in unit)
+    for unit in reversed(units[:last_user]):
+        if len(unit) > 1:
+            unit = unit[:1] + [await trim_tool(m, config.get("context_tool_tokens", 1000)) for m in unit[1:]]
+        size = sum(m.tokens for m in unit)
+        if used + size > budget:
+            break
+        kept.insert(0, unit)
+        used += size
+
+    result = system + [m for unit in kept for m in unit]
+    if len(result) < len(messages):
+        log.info(f"Context: dropped [bold]{len(messages) - len(result)}[/] oldest of {len(messages)} messages, sending ~{used} tokens")
+    return [await amaterialize(m.payload()) for m in result], used
@@ -1,19 +1,27 @@
 import json
+import os
+import sqlite3
+import sys
 
 from datetime import datetime
 from os.path import exists
-from typing import Optional, List, Union
+from threading import Lock, Thread
+from typing import Optional, List, Union, Dict, Iterable, Tuple
 
-from const import pricing
+from const import log, pricing
+from metrics import db_write_seconds, db_written_bytes
+from utils import message_tokens
 
 class Message(dict):
-    def __init__(self, role: str, content: Optional[str], tool_calls: Optional[List[dict]] = None, tool_call_id: Optional[str] = None, name: Optional[str] = None) -> None:
+    def __init__(self, role: str, content: Optional[str], tool_calls: Optional[List[dict]] = None, tool_call_id: Optional[str] = None, name: Optional[str] = None, tokens: Optional[int] = None) -> None:
         if tool_calls:
             super().__init__({"role": role, "content": content, "tool_calls": tool_calls})
         elif tool_call_id and name:
             super().__init__({"role": role, "content": content, "tool_call_id": tool_call_id, "name": name})
         else:
             super().__init__({"role": role, "content": content})
+        if tokens is not None:
+            self["tokens"] = tokens
 
 
     @property
@@ -31,15 +39,30 @@ class Message(dict):
         return self["tool_calls"]
 
 
+    @property
+    def tokens(self) -> int:
+        # Counted once and saved along with the message
+        if "tokens" not in self:
+            self["tokens"] = message_tokens(self)
+        return self["tokens"]
+
+
+    def payload(self) -> dict:
+        """The message as the API expects it (without the token count)"""
+        return {k: v for k, v in self.items() if k != "tokens"}
+
+
 class Chat(dict): 
-    def __init__(self, uid: int, owner: int, title: str, model: Optional[str] = "gpt-3.5-turbo", created_at: Union[int, datetime] = datetime.now(), last_accessed: Union[int, datetime] = datetime.now(), messages: List[Union[dict, Message]] = None) -> None:
+    def __init__(self, uid: int, owner: int, title: str, model: Optional[str] = "gpt-3.5-turbo", created_at: Union[int, datetime] = datetime.now(), last_accessed: Union[int, datetime] = datetime.now(), messages: List[Union[dict, Message]] = None, tokens: Optional[int] = None) -> None:
         if messages is not None and len(messages) > 0 and not isinstance(messages[0], Message):
             messages = list(map(lambda m: Message(**m), messages))
         if isinstance(created_at, datetime):
             created_at = int(created_at.timestamp())
         if isinstance(last_accessed, datetime):
             last_accessed = int(last_accessed.timestamp())
-        super().__init__({"uid": uid, "owner": owner, "title": title, "created_at": created_at, "last_accessed": last_accessed, "messages": messages or []})
+        if tokens is None:
+            tokens = sum(m.tokens for m in messages or [])
+        super().__init__({"uid": uid, "owner": owner, "title": title, "created_at": created_at, "last_accessed": last_accessed, "tokens": tokens, "messages": messages or []})
 
 
     @property
@@ -60,6 +83,12 @@ class Chat(dict):
     @property
     def messages(self) -> List[Message]:
         return self["messages"]
+
+
+    @property
+    def tokens(self) -> int:
+        """Running total of the message tokens"""
+        return self["tokens"]
     
 
     @property
@@ -92,90 +121,245 @@ class User(dict): # Create more settings
         return self["has_gpt4"]
 
 
+def load_snapshot(path: str) -> tuple:
+    with open(path) as f:
+        data = json.load(f)
+    users = {u["uid"]: User(**u) for u in data["users"]}
+    chats = {c["uid"]: Chat(**c) for c in data["chats"]}
+    return users, chats, data.get("seq", 0)
+
+
+def read_log(path: str) -> Iterable[dict]:
+    for record, _ in read_log_offsets(path):
+        yield record
+
+
+def read_log_offsets(path: str) -> Iterable[Tuple[dict, int]]:
+    """Records of the log with the byte offset right after each one. Stops at a torn write (a crash at the tail)"""
+    if not exists(path):
+        return
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                return
+            offset += len(line)
+            yield record, offset
+
+
+def apply_record(users: Dict[int, User], chats: Dict[int, Chat], record: dict) -> None:
+    match record["op"]:
+        case "user":
+            users[record["user"]["uid"]] = User(**record["user"])
+        case "chat":
+            chats[record["chat"]["uid"]] = Chat(**record["chat"])
+        case "message":
+            if chat := chats.get(record["chat"]):
+                message = Message(**record["message"])
+                chat.messages.append(message)
+                chat["tokens"] += message.tokens
+                chat["last_accessed"] = record["last_accessed"]
+        case "title":
+            if chat := chats.get(record["uid"]):
+                chat["title"] = record["title"]
+        case "delete_chat":
+            chats.pop(record["uid"], None)
+
+
+def write_snapshot(path: str, users: Iterable[User], chats: Iterable[Chat], seq: int) -> None:
+    with open(path + ".tmp", "w") as f:
+        json.dump({"users": list(users), "chats": list(chats), "seq": seq}, f, indent=2)
+        db_written_bytes.inc(f.tell(), backend="json")
+    os.replace(path + ".tmp", path)
+
+
+def compact(path: str, log_path: str) -> None:
+    """Folds an already rotated log into the snapshot. Works on disk only, so it can run in a thread"""
+    users, chats, seq = load_snapshot(path)
+    for record in read_log(log_path):
+        if record["seq"] > seq:
+            apply_record(users, chats, record)
+            seq = record["seq"]
+    write_snapshot(path, users.values(), chats.values(), seq)
+    os.remove(log_path)
+
+
+def compact_safely(path: str, log_path: str) -> None:
+    """compact() for the background thread. On failure the rotated log stays and the next compaction retries it"""
+    try:
+        compact(path, log_path)
+    except Exception as e:
+        log.error(f"Compaction of [bold]{log_path}[/] failed with [bold]{type(e).__name__}[/] ({e}), it will be retried")
+        log.exception()
+
+
 class Database():
-    chats: List[Chat] = []
-    users: List[User] = []
+    """JSON snapshot + append-only log. Every mutation is appended to `<path>.log` as one JSON line,
+    the log is replayed on startup and folded into the snapshot in a background thread.
+    Everything is kept in dicts: uid -> User, uid -> Chat and owner -> chats ordered by last_accessed"""
     path = ""
+    log_path = ""
+    compact_after = 1000
 
-    def __init__(self, path: str = "messages.json") -> None:
+    def __init__(self, path: str = "messages.json", compact_after: int = 1000) -> None:
         self.path = path
+        self.log_path = path + ".log"
+        self.compact_after = compact_after
+        self._lock = Lock()
+        self._compactor: Optional[Thread] = None
         if not exists(path):
-            with open(path, "w") as f:
-                json.dump({"users": [], "chats": []}, f)
-        with open(path) as f:
-            data = json.load(f)
-            self.chats = list(map(lambda c: Chat(**c), data["chats"]))
-            self.users = list(map(lambda u: User(**u), data["users"]))
+            write_snapshot(path, [], [], 0)
+        if exists(self.log_path + ".old"):
+            # Left over by a crash or a failed compaction, nothing else would fold it in
+            compact(path, self.log_path + ".old")
+
+        self._users, self._chats, self._seq = load_snapshot(path)
+        self._records = 0
+        valid = 0
+        for record, valid in read_log_offsets(self.log_path):
+            if record["seq"] > self._seq:
+                apply_record(self._users, self._chats, record)
+                self._seq = record["seq"]
+                self._records += 1
+        if exists(self.log_path) and os.path.getsize(self.log_path) > valid:
+            # Cut the torn tail, records appended after it would never be replayed
+            log.warn(f"Dropping [bold]{os.path.getsize(self.log_path) - valid} bytes[/] of a torn write at the end of [bold]{self.log_path}[/]")
+            os.truncate(self.log_path, valid)
+        self._log = open(self.log_path, "a")
+
+        self._next_id = max(self._chats.keys(), default=-1) + 1
+        # owner -> {uid: Chat}, least recently accessed first. Reinserting a key moves it to the end
+        self._owned: Dict[int, Dict[int, Chat]] = {}
+        for chat in sorted(self._chats.values(), key=lambda c: (c["last_accessed"], -c.uid)):
+            self._owned.setdefault(chat.owner, {})[chat.uid] = chat
+
+
+    @property
+    def users(self) -> List[User]:
+        return list(self._users.values())
+
+
+    @property
+    def chats(self) -> List[Chat]:
+        return list(self._chats.values())
+
+
+    @property
+    def files(self) -> List[str]:
+        return [self.path, self.log_path, self.log_path + ".old"]
+
+
+    def _append(self, op: str, **data) -> None:
+        self._seq += 1
+        with db_write_seconds.time(backend="json", op=op):
+            line = json.dumps({"op": op, "seq": self._seq, **data}) + "\n"
+            self._log.write(line)
+            self._log.flush()
+        db_written_bytes.inc(len(line.encode()), backend="json")
+        self._records += 1
+        if self._records >= self.compact_after:
+            self._start_compaction()
+
+
+    def _start_compaction(self) -> None:
+        with self._lock:
+            if self._compactor and self._compactor.is_alive():
+                return
+            # A rotated log still there means the last compaction failed, it is retried before rotating again
+            if not exists(self.log_path + ".old"):
+                self._log.close()
+                os.replace(self.log_path, self.log_path + ".old")
+                self._log = open(self.log_path, "a")
+                self._records = 0
+            self._compactor = Thread(target=compact_safely, args=(self.path, self.log_path + ".old"), daemon=True)
+            self._compactor.start()
 
 
     def commit(self) -> None:
-        with open(self.path, "w") as f:
-            json.dump({"users": self.users, "chats": self.chats}, f, indent=2)
+        """Writes a full snapshot and truncates the log. Mutations are persisted without it,
+        call it only after changing objects in place (e.g. user settings)"""
+        with self._lock:
+            if self._compactor:
+                self._compactor.join()
+            with db_write_seconds.time(backend="json", op="snapshot"):
+                write_snapshot(self.path, self._users.values(), self._chats.values(), self._seq)
+            self._log.close()
+            self._log = open(self.log_path, "w")
+            self._records = 0
+            if exists(self.log_path + ".old"):
+                os.remove(self.log_path + ".old")
 
 
     def user_exists(self, uid: int) -> bool:
-        return len(list(filter(lambda u: u.uid == uid, self.users))) > 0
+        return uid in self._users
 
 
     def create_user(self, uid: int, model: str = "gpt-3.5-turbo", has_gpt4: bool = False) -> User:
         if model not in pricing.keys():
             raise ValueError(f"Model {model} not found")
-        if len(list(filter(lambda u: u.uid == uid, self.users))) > 0:
+        if uid in self._users:
             raise ValueError(f"User {model} already exists")
         new_user = User(uid, model, has_gpt4)
-        self.users.append(new_user)
+        self._users[uid] = new_user
+        self._append("user", user=new_user)
         return new_user
 
 
     def get_user(self, uid: int) -> Optional[User]:
-        result = list(filter(lambda u: u.uid == uid, self.users))
-        if len(result) > 0:
-            return result[0]
-        else:
-            return None
+        return self._users.get(uid)
 
 
     def chat_exists(self, uid: int) -> bool:
-        return len(list(filter(lambda c: c.owner == uid, self.chats))) > 0
+        return len(self._owned.get(uid, ())) > 0
 
 
     def create_chat(self, title: str, owner: int, model: str = "gpt-3.5-turbo") -> Chat:
         if model not in pricing.keys():
             raise ValueError(f"Model {model} not found")
-        new_id = 0
-        if len(self.chats) > 0:
-            new_id = max(map(lambda c: c.uid, self.chats)) + 1
-        new_chat = Chat(new_id, owner, title, model)
-        self.chats.append(new_chat)
-        self.commit()
+        new_chat = Chat(self._next_id, owner, title, model)
+        self._next_id += 1
+        self._chats[new_chat.uid] = new_chat
+        self._owned.setdefault(owner, {})[new_chat.uid] = new_chat
+        self._append("chat", chat=new_chat)
         return new_chat
 
 
     def get_chat(self, uid: int) -> Optional[Chat]:
-        result = list(filter(lambda c: c.uid == uid, self.chats))
-        if len(result) > 0:
-            return result[0]
-        else:
-            return None
+        return self._chats.get(uid)
 
 
     def get_chats(self, owner: int) -> List[Chat]:
-        return sorted(filter(lambda c: c.owner == owner, self.chats), key=lambda c: c.last_accessed, reverse=True)
+        return list(reversed(self._owned.get(owner, {}).values()))
+
+
+    def set_title(self, uid: int, title: str) -> None:
+        """Does nothing if the chat was deleted meanwhile"""
+        if chat := self._chats.get(uid):
+            chat["title"] = title
+            self._append("title", uid=uid, title=title)
 
 
     def delete_chat(self, uid: int) -> None:
-        if not self.chat_exists(uid):
+        if (chat := self._chats.pop(uid, None)) is None:
             raise ValueError(f"Chat with uid {uid} does not exist")
-        self.chats = list(filter(lambda c: c.uid != uid, self.chats))
-        self.commit()
+        del self._owned[chat.owner][uid]
+        self._append("delete_chat", uid=uid)
 
 
-    def create_message(self, chat_id: int, role: str, *, content: Optional[Union[str, dict]] = None, tool_calls: Optional[List[dict]] = None, call_id: Optional[str] = None, function_name: Optional[str] = None) -> Message:
-        message = Message(role, content, tool_calls, call_id, function_name)
-        chat = self.get_chat(chat_id)
+    def create_message(self, chat_id: int, role: str, *, content: Optional[Union[str, dict]] = None, tool_calls: Optional[List[dict]] = None, call_id: Optional[str] = None, function_name: Optional[str] = None, tokens: Optional[int] = None) -> Message:
+        """`tokens` can be counted by the caller beforehand (compute.amessage_tokens), large results shouldn't be tokenized on the event loop"""
+        message = Message(role, content, tool_calls, call_id, function_name, tokens)
+        chat = self._chats[chat_id]
         chat.messages.append(message)
+        chat["tokens"] += message.tokens
         chat["last_accessed"] = int(datetime.now().timestamp())
-        self.commit()
+        owned = self._owned[chat.owner]
+        owned[chat_id] = owned.pop(chat_id)
+        self._append("message", chat=chat_id, message=message, last_accessed=chat["last_accessed"])
         return message
 
 
@@ -184,3 +368,163 @@ class Database():
             return chat.messages
         else:
             return []
+
+
+class SqliteDatabase():
+    """Same API as Database, but backed by SQLite: lookups go through indexes and only requested chats are loaded.
+    Chats returned by get_chats() have no messages loaded, use get_messages() for them"""
+    path = ""
+
+    def __init__(self, path: str = "messages.db") -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA foreign_keys = ON;
+            CREATE TABLE IF NOT EXISTS users (
+                uid INTEGER PRIMARY KEY,
+                model TEXT NOT NULL,
+                has_gpt4 INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chats (
+                uid INTEGER PRIMARY KEY AUTOINCREMENT,
+                owner INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                last_accessed INTEGER NOT NULL,
+                tokens INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat INTEGER NOT NULL REFERENCES chats(uid) ON DELETE CASCADE,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chats_owner ON chats(owner, last_accessed);
+            CREATE INDEX IF NOT EXISTS messages_chat ON messages(chat);
+        """)
+        self._users: Dict[int, User] = {}
+        self._migrate()
+
+
+    def _migrate(self) -> None:
+        """Brings databases created by older versions up to the current schema"""
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(chats)")]
+        if "tokens" not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE chats ADD COLUMN tokens INTEGER NOT NULL DEFAULT 0")
+                totals: Dict[int, int] = {}
+                for chat, data in self.connection.execute("SELECT chat, data FROM messages"):
+                    totals[chat] = totals.get(chat, 0) + Message(**json.loads(data)).tokens
+                self.connection.executemany("UPDATE chats SET tokens = ? WHERE uid = ?", [(tokens, uid) for uid, tokens in totals.items()])
+
+
+    @property
+    def files(self) -> List[str]:
+        return [self.path, self.path + "-wal"]
+
+
+    def _commit(self, op: str) -> None:
+        with db_write_seconds.time(backend="sqlite", op=op):
+            self.connection.commit()
+
+
+    def commit(self) -> None:
+        self.connection.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                                    [(u.uid, u.model, u.has_gpt4) for u in self._users.values()])
+        self._commit("users")
+
+
+    def user_exists(self, uid: int) -> bool:
+        return self.get_user(uid) is not None
+
+
+    def create_user(self, uid: int, model: str = "gpt-3.5-turbo", has_gpt4: bool = False) -> User:
+        if model not in pricing.keys():
+            raise ValueError(f"Model {model} not found")
+        if self.user_exists(uid):
+            raise ValueError(f"User {model} already exists")
+        new_user = User(uid, model, has_gpt4)
+        self._users[uid] = new_user
+        self.connection.execute("INSERT INTO users VALUES (?, ?, ?)", (uid, model, has_gpt4))
+        self._commit("user")
+        return new_user
+
+
+    def get_user(self, uid: int) -> Optional[User]:
+        # Cached so in-place changes (user["model"] = ...) are saved by commit()
+        if uid not in self._users:
+            row = self.connection.execute("SELECT uid, model, has_gpt4 FROM users WHERE uid = ?", (uid,)).fetchone()
+            if row is None:
+                return None
+            self._users[uid] = User(row[0], row[1], bool(row[2]))
+        return self._users[uid]
+
+
+    def chat_exists(self, uid: int) -> bool:
+        return self.connection.execute("SELECT 1 FROM chats WHERE owner = ? LIMIT 1", (uid,)).fetchone() is not None
+
+
+    def create_chat(self, title: str, owner: int, model: str = "gpt-3.5-turbo") -> Chat:
+        if model not in pricing.keys():
+            raise ValueError(f"Model {model} not found")
+        now = int(datetime.now().timestamp())
+        cursor = self.connection.execute("INSERT INTO chats (owner, title, created_at, last_accessed) VALUES (?, ?, ?, ?)",
+                                         (owner, title, now, now))
+        self._commit("chat")
+        return Chat(cursor.lastrowid, owner, title, model, now, now)
+
+
+    def get_chat(self, uid: int) -> Optional[Chat]:
+        row = self.connection.execute("SELECT uid, owner, title, created_at, last_accessed, tokens FROM chats WHERE uid = ?", (uid,)).fetchone()
+        if row is None:
+            return None
+        return Chat(*row[:3], created_at=row[3], last_accessed=row[4], messages=self.get_messages(uid), tokens=row[5])
+
+
+    def get_chats(self, owner: int) -> List[Chat]:
+        rows = self.connection.execute("SELECT uid, owner, title, created_at, last_accessed, tokens FROM chats WHERE owner = ? ORDER BY last_accessed DESC", (owner,))
+        return [Chat(*row[:3], created_at=row[3], last_accessed=row[4], tokens=row[5]) for row in rows]
+
+
+    def set_title(self, uid: int, title: str) -> None:
+        self.connection.execute("UPDATE chats SET title = ? WHERE uid = ?", (title, uid))
+        self._commit("title")
+
+
+    def delete_chat(self, uid: int) -> None:
+        if self.connection.execute("DELETE FROM chats WHERE uid = ?", (uid,)).rowcount == 0:
+            raise ValueError(f"Chat with uid {uid} does not exist")
+        self._commit("delete_chat")
+
+
+    def create_message(self, chat_id: int, role: str, *, content: Optional[Union[str, dict]] = None, tool_calls: Optional[List[dict]] = None, call_id: Optional[str] = None, function_name: Optional[str] = None, tokens: Optional[int] = None) -> Message:
+        message = Message(role, content, tool_calls, call_id, function_name, tokens)
+        message.tokens  # counted before saving, so it is stored with the message
+        self.connection.execute("INSERT INTO messages (chat, data) VALUES (?, ?)", (chat_id, json.dumps(message)))
+        self.connection.execute("UPDATE chats SET last_accessed = ?, tokens = tokens + ? WHERE uid = ?", (int(datetime.now().timestamp()), message.tokens, chat_id))
+        self._commit("message")
+        return message
+
+
+    def get_messages(self, chat_id: int) -> List[Message]:
+        rows = self.connection.execute("SELECT data FROM messages WHERE chat = ? ORDER BY id", (chat_id,))
+        return [Message(**json.loads(row[0])) for row in rows]
+
+
+def migrate(json_path: str = "messages.json", sqlite_path: str = "messages.db") -> None:
+    """One-shot conversion of a JSON database (snapshot and log) into SQLite, keeping chat ids"""
+    source = Database(json_path)
+    target = SqliteDatabase(sqlite_path)
+    with target.connection:
+        target.connection.executemany("INSERT INTO users VALUES (?, ?, ?)",
+                                      [(u.uid, u.model, u.has_gpt4) for u in source.users])
+        target.connection.executemany("INSERT INTO chats VALUES (?, ?, ?, ?, ?, ?)",
+                                      [(c.uid, c.owner, c.title, c["created_at"], c["last_accessed"], c.tokens) for c in source.chats])
+        target.connection.executemany("INSERT INTO messages (chat, data) VALUES (?, ?)",
+                                      [(c.uid, json.dumps(m)) for c in source.chats for m in c.messages])
+
+
+if __name__ == "__main__":
+    # python database.py [messages.json] [messages.db]
+    migrate(*sys.argv[1:3])
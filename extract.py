@@ -0,0 +1,50 @@
+import re
+
+from typing import Optional
+
+from bs4 import BeautifulSoup
+
+from const import log
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+# Not visible or repeated on every page
+boilerplate = ("script", "style", "head", "noscript", "template", "svg", "nav", "footer")
+separator = re.compile(r"\s*(?:[\r\n]|  )\s*")
+meta_charset = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.IGNORECASE)
+
+
+async def read_body(response, limit: int) -> bytes:
+    """Reads the body in chunks and stops at `limit` bytes, the rest is never downloaded"""
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(2**16):
+        body += chunk
+        if len(body) >= limit:
+            log.warn(f"Response of [bold]{response.url}[/] is larger than [bold]{limit} bytes[/], the rest is skipped")
+            del body[limit:]
+            break
+    return bytes(body)
+
+
+def extract_text(body: bytes, charset: Optional[str] = None) -> str:
+    """Visible text of an HTML page, one block per line. Blocking, run it in an executor"""
+    if charset is None and (match := meta_charset.search(body, 0, 4096)):
+        charset = match.group(1).decode()
+    if lxml is not None:
+        try:
+            parser = lxml.html.HTMLParser(encoding=charset or "utf-8", remove_comments=True)
+            document = lxml.html.document_fromstring(body, parser=parser)
+        except (etree.ParserError, LookupError):
+            return ""
+        etree.strip_elements(document, *boilerplate, with_tail=False)
+        text = "".join(document.itertext())
+    else:
+        soup = BeautifulSoup(body, features="html.parser", from_encoding=charset)
+        for element in soup(boilerplate):
+            element.extract()
+        text = soup.get_text()
+    return "\n".join(phrase for phrase in separator.split(text) if phrase)
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import resource
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from collections import Counter
+from itertools import count
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from time import monotonic, time
+
+import const
+import utils  # loads the tokenizer from the relative cache dir before the working directory changes
+
+from logger import levels
+from metrics import db_written_bytes
+from webhook import fake_update
+
+# Usage: python loadtest.py --users 20 --turns 3 [--database sqlite] [--no-stream] ... (see --help)
+# Runs the bot against local stand-ins of OpenAI, the Bot API, Google CSE and Wolfram in one process
+
+
+def words(count: int) -> list:
+    return [f"word{i % 100} " for i in range(count)]
+
+
+class FakeServices:
+    """One aiohttp app for every external service. The chat model asks for tools for `tool_rounds`
+    rounds after each user message (search + wolfram, then ask_webpage) and answers after that"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.base = ""
+        self.calls: Counter = Counter()
+        self.pending = {}  # chat id -> future resolved by the message that ends a turn
+        self.message_ids = 0
+        self.tool_ids = count(1)
+        self.runner = None
+
+
+    async def start(self) -> None:
+        app = web.Application(client_max_size=64 * 2**20)
+        app.router.add_post("/v1/chat/completions", self.completions)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_get("/search", self.search)
+        app.router.add_get("/wolfram", self.wolfram)
+        app.router.add_get("/page/{name}", self.page)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.base = f"http://{host}:{port}"
+
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+    def _tool_calls(self, messages: list) -> list:
+        last_user = max(i for i, m in enumerate(messages) if m["role"] == "user")
+        done = sum(1 for m in messages[last_user:] if m.get("tool_calls"))
+        if done >= self.args.tool_rounds:
+            return []
+        tag = next(self.tool_ids)  # unique arguments, so the tool cache never answers
+        if done % 2 == 0:
+            calls = [("search", {"query": f"load test {tag}"}), ("wolfram", {"query": f"integral {tag}"})]
+        else:
+            calls = [("ask_webpage", {"url": f"{self.base}/page/{tag}", "prompt": "Summarize the page"})]
+        return [{"id": f"call_{tag}_{i}", "type": "function", "function": {"name": name, "arguments": json.dumps(args)}}
+                for i, (name, args) in enumerate(calls)]
+
+
+    def _answer(self, body: dict) -> dict:
+        system = body["messages"][0]["content"] if body["messages"][0]["role"] == "system" else ""
+        if system.startswith("Your goal is to create a short"):
+            return {"role": "assistant", "content": "Load test chat"}
+        calls = self._tool_calls(body["messages"]) if body.get("tools") and body.get("tool_choice") != "none" else []
+        if calls:
+            return {"role": "assistant", "content": None, "tool_calls": calls}
+        return {"role": "assistant", "content": "".join(words(self.args.answer_tokens))}
+
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.calls["completions"] += 1
+        await asyncio.sleep(self.args.openai_latency)
+        message = self._answer(body)
+        prompt = sum(utils.message_tokens(m) for m in body["messages"])
+        completion = utils.message_tokens(message)
+        chunk = {"id": "chatcmpl-test", "created": int(time()), "model": body["model"]}
+        if not body.get("stream"):
+            return web.json_response({**chunk, "object": "chat.completion", "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                                      "usage": {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        if message.get("tool_calls"):
+            deltas = [{"tool_calls": [{"index": i, "id": call["id"], "type": "function", "function": {"name": call["function"]["name"], "arguments": ""}}]}
+                      for i, call in enumerate(message["tool_calls"])]
+            deltas += [{"tool_calls": [{"index": i, "function": {"arguments": call["function"]["arguments"]}}]} for i, call in enumerate(message["tool_calls"])]
+        else:
+            deltas = [{"content": word} for word in words(self.args.answer_tokens)]
+        for delta in [{"role": "assistant"}] + deltas:
+            data = {**chunk, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(data)}\n\n".encode())
+            await asyncio.sleep(self.args.token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[f"telegram {method}"] += 1
+        await asyncio.sleep(self.args.telegram_latency)
+        chat_id = int(data.get("chat_id", 0))
+        text = data.get("text", "")
+        if method == "sendMessage" and text.startswith(("📊", "❌", "⏳", "⚠️")):
+            if (future := self.pending.pop(chat_id, None)) is not None and not future.done():
+                future.set_result(text)
+        self.message_ids += 1
+        message = {"message_id": self.message_ids, "date": int(time()), "chat": {"id": chat_id, "type": "private"}, "text": text}
+        result = {"sendMessage": message, "editMessageText": message, "sendMediaGroup": [message]}.get(method, True)
+        return web.json_response({"ok": True, "result": result})
+
+
+    async def search(self, request: web.Request) -> web.Response:
+        self.calls["search"] += 1
+        await asyncio.sleep(self.args.search_latency)
+        query = request.query["q"]
+        return web.json_response({"items": [{"title": f"Result {i} for {query}", "link": f"{self.base}/page/{i}"} for i in range(10)]})
+
+
+    async def wolfram(self, request: web.Request) -> web.Response:
+        self.calls["wolfram"] += 1
+        await asyncio.sleep(self.args.search_latency)
+        return web.Response(text=f"Query: {request.query['input']}\nResult: 42")
+
+
+    async def page(self, request: web.Request) -> web.Response:
+        self.calls["page"] += 1
+        await asyncio.sleep(self.args.search_latency)
+        paragraphs = "".join(f"<p>{''.join(words(100))}</p>" for _ in range(max(1, self.args.page_tokens // 100)))
+        return web.Response(text=f"<html><head><title>Page</title></head><body>{paragraphs}</body></html>", content_type="text/html")
+
+
+async def simulate_user(app, services: FakeServices, user: int, args: argparse.Namespace, latencies: list, errors: Counter) -> None:
+    for turn in range(args.turns):
+        future = asyncio.get_running_loop().create_future()
+        services.pending[user] = future
+        start = monotonic()
+        await app.dp.process_update(types.Update(**fake_update(user * 1000 + turn, user, f"Question {turn} from user {user}")))
+        try:
+            result = await asyncio.wait_for(future, args.timeout)
+        except asyncio.TimeoutError:
+            errors["timeout"] += 1
+            continue
+        if not result.startswith("📊"):
+            errors[result.split(" ")[0]] += 1
+            continue
+        latencies.append(monotonic() - start)
+        await asyncio.sleep(args.think)
+
+
+def database_bytes(db) -> tuple:
+    """Bytes written to the database files and the size of the stored messages themselves"""
+    if hasattr(db, "connection"):
+        payload = sum(len(row[0]) for row in db.connection.execute("SELECT data FROM messages"))
+        # SQLite does not report its writes, the size of the database and its WAL stands in for them
+        return sum(os.path.getsize(path) for path in db.files if os.path.exists(path)), payload
+    payload = sum(len(json.dumps(m)) for chat in db.chats for m in db.get_messages(chat.uid))
+    return sum(db_written_bytes.values.values()), payload
+
+
+async def run(args: argparse.Namespace) -> dict:
+    services = FakeServices(args)
+    await services.start()
+    users = list(range(1, args.users + 1))
+    const.config.update({
+        "bot_token": "123456:ABCdefGhIJKlmNoPQRsTUVwxyZ0123456789",
+        "telegram_api": services.base,
+        "openai_api": f"{services.base}/v1",
+        "search_url": f"{services.base}/search",
+        "wolfram_url": f"{services.base}/wolfram",
+        "whitelist": users,
+        "database": args.database,
+        "stream": args.stream,
+        "metrics_port": None,
+        "cache_path": None
+    })
+    if not args.rate_limits:
+        const.config["rate_limits"] = {}
+    const.log.level = levels[args.log_level]
+    # Imported here so the bot picks up the config above and keeps its files in the temporary directory
+    app = importlib.import_module("main")
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dp)
+    await app.on_startup(app.dp)
+
+    latencies, errors = [], Counter()
+    start = monotonic()
+    await asyncio.gather(*(simulate_user(app, services, user, args, latencies, errors) for user in users))
+    elapsed = monotonic() - start
+    await app.queue.join()
+    await asyncio.gather(*app.background_tasks)
+
+    written, payload = database_bytes(app.db)
+    await app.on_shutdown(app.dp)
+    await (await app.bot.get_session()).close()
+    await services.stop()
+
+    percentiles = quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0] if latencies else 0.0] * 99
+    return {
+        "users": args.users,
+        "turns": len(latencies),
+        "errors": dict(errors),
+        "seconds": round(elapsed, 2),
+        "throughput": round(len(latencies) / elapsed, 3),
+        "p50": round(percentiles[49], 3),
+        "p95": round(percentiles[94], 3),
+        "p99": round(percentiles[98], 3),
+        "db_written_bytes": written,
+        "db_payload_bytes": payload,
+        "write_amplification": round(written / payload, 2) if payload else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "calls": dict(services.calls)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end load test against local fake services")
+    parser.add_argument("--users", type=int, default=10, help="simulated users sending messages concurrently")
+    parser.add_argument("--turns", type=int, default=3, help="messages per user, each sent after the previous answer")
+    parser.add_argument("--think", type=float, default=0, help="seconds a user waits between turns")
+    parser.add_argument("--database", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--tool-rounds", type=int, default=2, help="tool rounds before the model answers")
+    parser.add_argument("--answer-tokens", type=int, default=300)
+    parser.add_argument("--page-tokens", type=int, default=3000, help="size of the pages given to ask_webpage")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="seconds before a completion starts")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="seconds between streamed chunks")
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--search-latency", type=float, default=0.1, help="search, Wolfram and webpage latency")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the rate_limits of config.yml, off by default")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for one answer")
+    parser.add_argument("--log-level", default="error", choices=levels.keys())
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    with TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        results = asyncio.run(run(args))
+
+    print(f"{results['users']} users, {results['turns']} turns in {results['seconds']}s ({results['throughput']} turns/s), errors: {results['errors'] or 'none'}")
+    print(f"Turn latency: p50 {results['p50']}s, p95 {results['p95']}s, p99 {results['p99']}s")
+    print(f"Database: {results['db_written_bytes']} bytes written for {results['db_payload_bytes']} bytes of messages "
+          f"(write amplification {results['write_amplification']})")
+    print(f"Peak RSS: {results['peak_rss_mb']} MiB (fake services included)")
+    print("Calls: " + ", ".join(f"{name} {count}" for name, count in sorted(results["calls"].items())))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,147 @@
-from rich.console import Console
+import atexit
+import json
+import sys
+
 from datetime import datetime
+from queue import Full, Queue
+from rich.console import Console
+from rich.markup import render
+from rich.traceback import Traceback
+from threading import Event, Thread
+from time import time
+from typing import Dict, List, Optional
+
+levels = {"debug": 10, "info": 20, "success": 25, "warn": 30, "error": 40, "fatal": 50}
+prefixes = {
+    "debug": "[cyan bold][-][/]",
+    "info": "[blue bold][*][/]",
+    "success": "[green bold][✔][/]",
+    "warn": "[yellow bold][!][/]",
+    "error": "[red bold][✘][/]",
+    "fatal": "[on red bold][✘][/]"
+}
 
 
-def get_date() -> str:
-    return datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+def get_date(timestamp: Optional[float] = None) -> str:
+    return (datetime.fromtimestamp(timestamp) if timestamp else datetime.now()).strftime('%d.%m.%Y %H:%M:%S')
 
 
 class Logger:
+    """Calls only put a record on a queue, formatting and writing happen in a background thread.
+    Records below `level` are dropped right away, a message repeated within `dedupe_seconds` is printed once
+    with the number of repeats. With `json_path` every record is also appended there as one JSON line"""
     console: Console
 
-    def __init__(self, console=Console(highlight=False)) -> None:
+    def __init__(self, console=Console(highlight=False), level: str = "debug", json_path: Optional[str] = None, dedupe_seconds: float = 0, max_queue: int = 10000) -> None:
         self.console = console
+        self.level = levels[level]
+        self.dedupe_seconds = dedupe_seconds
+        self.json_file = open(json_path, "a") if json_path else None
+        self.records: Queue = Queue(max_queue)
+        self.dropped = 0
+        self.seen: Dict[tuple, List[float]] = {}  # (level, message) -> [suppressed until, repeats], writer thread only
+        self.thread = Thread(target=self._run, name="logger", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _put(self, record: tuple) -> None:
+        try:
+            self.records.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def _log(self, level: str, msg: str, exc_info: Optional[tuple] = None) -> None:
+        if levels[level] >= self.level:
+            self._put((level, time(), msg, exc_info))
+
+    def _run(self) -> None:
+        while True:
+            record = self.records.get()
+            if record is None:
+                self._flush_repeats(time(), everything=True)
+                return
+            if isinstance(record, Event):
+                record.set()
+                continue
+            try:
+                self._write(*record)
+            except Exception as e:  # never let a bad record stop the writer
+                print(f"Logger failed to write a record: {type(e).__name__} ({e})", file=sys.stderr)
+
+    def _write(self, level: str, timestamp: float, msg: Optional[str], exc_info: Optional[tuple]) -> None:
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self._emit("warn", timestamp, f"Log queue was full, [bold]{dropped}[/] records were dropped")
+        if exc_info is None and self.dedupe_seconds > 0:
+            key = (level, msg)
+            entry = self.seen.get(key)
+            if entry is not None and timestamp < entry[0]:
+                entry[1] += 1
+                return
+            if entry is not None and entry[1] > 0:
+                msg += f" [dim](and {int(entry[1])} times before)[/]"
+            self.seen[key] = [timestamp + self.dedupe_seconds, 0]
+            if len(self.seen) > 1000:
+                self._flush_repeats(timestamp)
+        self._emit(level, timestamp, msg, exc_info)
+
+    def _flush_repeats(self, timestamp: float, everything: bool = False) -> None:
+        """Reports the suppressed repeats of expired messages (or all of them) and forgets those messages"""
+        for (level, msg), (until, repeats) in list(self.seen.items()):
+            if until <= timestamp or everything:
+                if repeats > 0:
+                    self._emit(level, timestamp, f"{msg} [dim](repeated {int(repeats)} times)[/]")
+                del self.seen[(level, msg)]
+
+    def _emit(self, level: str, timestamp: float, msg: Optional[str], exc_info: Optional[tuple] = None) -> None:
+        if msg is not None:
+            self.console.print(f"[dim bold][{get_date(timestamp)}][/] {prefixes[level]} {msg}")
+        if exc_info is not None:
+            self.console.print(Traceback.from_exception(*exc_info))
+        if self.json_file is not None:
+            line = {"time": datetime.fromtimestamp(timestamp).isoformat(), "level": level, "message": render(msg).plain if msg else None}
+            if exc_info is not None:
+                line["exception"] = f"{exc_info[0].__name__}: {exc_info[1]}"
+            self.json_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+            self.json_file.flush()
+
+    def flush(self, timeout: float = 5) -> None:
+        """Waits until the records logged so far are written"""
+        if self.thread.is_alive():
+            done = Event()
+            self._put(done)
+            done.wait(timeout)
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.records.put(None)
+            self.thread.join(5)
+        if self.json_file is not None and not self.json_file.closed:
+            self.json_file.close()
 
     def debug(self, msg: str) -> None:
-        self.console.print(f"[dim bold][{get_date()}][/] [cyan bold][-][/] {msg}")
+        self._log("debug", msg)
 
     def info(self, msg: str) -> None:
-        self.console.print(f"[dim bold][{get_date()}][/] [blue bold][*][/] {msg}")
+        self._log("info", msg)
 
     def success(self, msg: str) -> None:
-        self.console.print(f"[dim bold][{get_date()}][/] [green bold][✔][/] {msg}")
+        self._log("success", msg)
 
     def warn(self, msg: str) -> None:
-        self.console.print(f"[dim bold][{get_date()}][/] [yellow bold][!][/] {msg}")
+        self._log("warn", msg)
 
     def error(self, msg: str) -> None:
-        self.console.print(f"[dim bold][{get_date()}][/] [red bold][✘][/] {msg}")
+        self._log("error", msg)
 
     def fatal(self, msg: str) -> None:
-        self.console.print(f"[dim bold][{get_date()}][/] [on red bold][✘][/] {msg}")
+        self._log("fatal", msg)
+
+    def exception(self, msg: Optional[str] = None) -> None:
+        """Logs the exception being handled with its traceback, rendered in the writer thread"""
+        if levels["error"] >= self.level:
+            self._put(("error", time(), msg, sys.exc_info()))
 
     def input(self, msg="") -> str:
+        self.flush()
         return self.console.input(f"[purple bold][→][/] {msg} > ")
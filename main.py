@@ -1,17 +1,31 @@
-import base64
+import asyncio
+import compute
 import openai
+import os
 
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.bot.api import TelegramAPIServer
 from datetime import datetime
 from io import BytesIO
 from math import ceil
 from random import randint
-from typing import Dict
+from signal import SIGINT, SIGTERM
+from typing import Dict, List, Set, Tuple
 
+from blobs import blobs
+from compute import ato_html, lag, executor as compute_executor
 from const import *
+from context import build_context, tools_tokens
 from database import *
 from funcs import *
+from metrics import Gauge, TimedBot, openai_tokens, request_rounds, request_seconds, span, tool_seconds, trace
+from metrics import start_server as start_metrics, stop_server as stop_metrics
+from ratelimit import chat_completion
+from session import start_session, close_session
+from scheduler import ChatQueue, current_user, openai_limiter
+from stream import *
 from utils import *
+from webhook import WebhookServer
 
 # === TODO ===
 # Apis:
@@ -19,20 +33,26 @@ from utils import *
 # - Image search
 #
 # Code:
-# - Cut tokens so the model would not overflow
+# - [Done] Cut tokens so the model would not overflow
 # - Ability to select model
 #   - [Done] Per-user
 #   - Chat
 #   - Website analyzer
 # - Admin panel
 
-bot = Bot(config["bot_token"])
+bot = TimedBot(config["bot_token"], server=TelegramAPIServer.from_base(config.get("telegram_api", "https://api.telegram.org")))
 dp = Dispatcher(bot)
-db = Database()
+db = SqliteDatabase() if config.get("database") == "sqlite" else Database()
 openai.api_key = config["openai_token"]
+openai.api_base = config.get("openai_api", openai.api_base)
 
 selected_chats: Dict[int, int] = {}
 
+Gauge("db_file_bytes", "Size of the database files", ("file",), lambda: {(path,): os.path.getsize(path) for path in db.files if os.path.exists(path)})
+Gauge("queue_depth", "Work waiting in a queue", ("queue",), lambda: {("messages",): queue.depth, ("openai",): openai_limiter.queued})
+Gauge("running", "Work in progress", ("kind",), lambda: {("turns",): len(queue.workers), ("openai",): openai_limiter.active})
+background_tasks: Set[asyncio.Task] = set()  # the loop keeps only weak references to tasks
+
 
 @dp.callback_query_handler()
 async def callback_handler(query: types.CallbackQuery):
@@ -99,7 +119,8 @@ async def callback_handler(query: types.CallbackQuery):
         await query.message.answer(f"#{chat.uid}\n" + \
                                     f"Chat title: <b>{chat.title}</b>\n" + \
                                     f"Created at <b>{chat.created_at.strftime('%H:%M %d.%m.%Y')}</b>\n" + \
-                                    f"Last accessed <b>{chat.last_accessed.strftime('%H:%M %d.%m.%Y')}</b>",
+                                    f"Last accessed <b>{chat.last_accessed.strftime('%H:%M %d.%m.%Y')}</b>\n" + \
+                                    f"Size <b>{chat.tokens} tokens</b>",
                                     parse_mode="html",
                                     reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons))
                                     # TODO: created and accessed at
@@ -161,14 +182,7 @@ async def on_askweb(message: types.Message):
     url = split[1]
     question = " ".join(split[2:])
     new = await message.answer("🧠 Starting generating...")
-    result = to_html(await ask_webpage(url, question))
-    if len(result) > 3500:
-        chunked = chunks(result, 3500)
-        await new.edit_text(chunked[0], parse_mode="html")
-        for chunk in chunked[1:]:
-            await new.answer(chunk, parse_mode="html")
-    else:
-        await new.edit_text(result, parse_mode="html")
+    await send_html(new, await ato_html(await ask_webpage(url, question)), edit=True)
 
 
 @dp.message_handler(commands=["keyres"])
@@ -242,105 +256,252 @@ async def on_model(message: types.Message):
                        f"📃 Available {', '.join(map(lambda s: f'<code>{s.lower()}</code>', pricing.keys()))}", parse_mode="html")
 
 
-async def generate_result(message: types.Message, start_prompt: str, level: int = 0, call_id: int = randint(0, 65535), tokens: int = 0, sources: Optional[List[str]] = None, images: Optional[List[str]] = None) -> None:
-    user = db.get_user(message.chat.id)
-    try:
-        if level == 0:
-            log.info(f"Starting generation from [bold]{message.chat.full_name} ({message.chat.id})[/] with prompt [bold]{truncate_text(start_prompt)}[/] / [bold]0x{call_id:04x}[/] on [bold]{user.model}[/]")
-
-        sources: List[str] = sources or []
-        images: List[str] = images or []
-        start = datetime.now()
-        response = await openai.ChatCompletion.acreate(
-            model=user.model,
-            messages=db.get_messages(selected_chats[message.chat.id]),
-            max_tokens=2048,
-            tools=functions
-        )
-        spent = str(round((datetime.now() - start).total_seconds(), 2))
-        tokens_total = response["usage"]["total_tokens"]
-        tokens_prompt = response["usage"]["prompt_tokens"]
-        tokens_completion = tokens_total - tokens_prompt
-        
-        if level != 0:
-            log.info(f"Sub-call [bold]#{level:02d}[/] for [bold]0x{call_id:04x}[/] is done ([bold]{tokens_total}[/] tokens)")
-
-        msg = response["choices"][0]["message"]
-        if msg["content"]:
-            await message.delete()
-            if tokens_completion == 0:
-                await message.answer("📭 Model returned nothing (zero-length text)")
-            else:
-                result = to_html(msg["content"])
-                chunked = chunks(result, 3500)
-                for chunk in chunked:
-                    await message.answer(chunk, parse_mode="html", disable_web_page_preview=True)
-
-            if len(images) > 0:
-                images = list(map(lambda i: types.InputMediaPhoto(i), images))
-                await message.answer_media_group(images)
-            if len(sources) > 0:
-                await message.answer("<b>📜 Sources</b>\n" + \
-                                    "\n".join(map(lambda s: f"<a href='{s}'>{parse_domain(s)}</a>", sources)), 
-                                    parse_mode="html", disable_web_page_preview=True)            
-            db.create_message(selected_chats[message.chat.id], "assistant", content=msg["content"])
-            if level == 0:
-                log.success(f"Generation of [bold]{truncate_text(start_prompt)}[/] / [bold]0x{call_id:04x}[/] finished. Used [bold]{tokens_total}[/] tokens. Spent [bold]{spent}s[/]")
-                await message.answer( # TODO: bring price back
-                    f"📊 Used tokens *{tokens_total}*\n" + \
-                    f"⌛ Time spent *{escape(spent)}s*",
-                    parse_mode="MarkdownV2")
-
-            return tokens+tokens_total
-        elif msg["tool_calls"]:
-            calls = msg["tool_calls"]
-            db.create_message(selected_chats[message.chat.id], "assistant", tool_calls=calls)
-            for call in calls:
-                func = call['function']
-                args = json.loads(func["arguments"])
-                if func["name"] == "add_image":
-                    if await verify_image(args["url"], supported_images): 
-                        images.append(args["url"])
-                        db.create_message(selected_chats[message.chat.id], "tool", content="Done!", call_id=call["id"], function_name="add_image")
-                    else:
-                        db.create_message(selected_chats[message.chat.id], "tool", content=f"Invalid image specified! Only {supported_images} are supported", call_id=call["id"], function_name="add_image")
-                elif func["name"] in py_functions.keys():
-                    log.info(f"Calling [bold]{func['name']}[/] with [bold]{func['arguments']}[/]")
-                    await message.answer(display_function(func['name'], args), parse_mode="html", disable_web_page_preview=True)
-                    if func["name"] == "ask_webpage":
-                        sources.append(args["url"])
-                    try:
-                        resp = await py_functions[func["name"]](**args)
-                        db.create_message(selected_chats[message.chat.id], "tool", 
-                                        content=resp, call_id=call["id"], function_name=func["name"])
-                    except Exception as e:
-                        log.warn(f"Caught exception [bold]{type(e).__name__}[/] ({'. '.join(map(str, e.args))}) while trying to use [bold]{func['name']}[/]") 
-                        log.console.print_exception()
-                        db.create_message(selected_chats[message.chat.id], "tool", 
-                                        content=f"Failed to use function {func['name']}: {type(e).__name__} ({'. '.join(map(str, e.args))})", call_id=call["id"], function_name=func["name"])
+async def run_tool(message: types.Message, call: dict, semaphore: asyncio.Semaphore, sources: List[str]) -> Tuple[str, Optional[str]]:
+    """Runs one tool call, timed and traced. Returns the tool message content and the image to attach (for add_image)"""
+    name = call["function"]["name"]
+    with span(f"tool {name}") as tool:
+        result = await call_tool(message, call, semaphore, sources)
+    # The name comes from the model, made-up ones would add label values without end
+    tool_seconds.observe(tool.seconds, function=name if name in py_functions or name == "add_image" else "unknown")
+    return result
 
-                else:
-                    log.warn(f"GPT tried to call non-existing {func['name']}")
-                    await message.answer(f"❌ GPT tried to call non-existing <code>{func['name']}</code>", parse_mode="html")
-                    db.create_message(selected_chats[message.chat.id], "tool", content=f"Function {func['name']} not found!", call_id=call["id"], function_name=func["name"])
-            
-            used = await generate_result(message, start_prompt, level+1, call_id, tokens+tokens_total, sources, images)
-            if level == 0:
-                log.success(f"Generation of [bold]{truncate_text(start_prompt)}[/] / [bold]0x{call_id:04x}[/] finished. Used [bold]{used+tokens_total}[/] tokens. Spent [bold]{spent}s[/]")
-                await message.answer( # TODO: bring price back
-                    f"📊 Used tokens *{used+tokens_total}*\n" + \
-                    f"⌛ Time spent *{escape(spent)}s*",
-                    parse_mode="MarkdownV2")
-
-            return used+tokens_total
+
+async def call_tool(message: types.Message, call: dict, semaphore: asyncio.Semaphore, sources: List[str]) -> Tuple[str, Optional[str]]:
+    """Never raises (except on cancellation): a failed call becomes its error message, so every call of the turn gets an answer"""
+    func = call['function']
+    try:
+        args = json.loads(func["arguments"])
+        timeout = config.get("tool_timeouts", {}).get(func["name"])
+        if func["name"] == "add_image":
+            # Only the first bytes are needed, so the checks of a turn don't wait for the tool slots
+            try:
+                valid = await asyncio.wait_for(verify_image(args["url"], supported_images), timeout)
+            except asyncio.TimeoutError:
+                log.warn(f"Image check of [bold]{args['url']}[/] timed out")
+                valid = False
+            if valid:
+                return "Done!", args["url"]
+            return f"Invalid image specified! Only {supported_images} are supported", None
+        elif func["name"] in py_functions.keys():
+            log.info(f"Calling [bold]{func['name']}[/] with [bold]{func['arguments']}[/]")
+            await message.answer(display_function(func['name'], args), parse_mode="html", disable_web_page_preview=True)
+            if func["name"] == "ask_webpage":
+                sources.append(args["url"])
+            async with semaphore:
+                return await asyncio.wait_for(py_functions[func["name"]](**args), timeout), None
         else:
-            log.error("Empty message!..")
-            return 0
+            log.warn(f"GPT tried to call non-existing {func['name']}")
+            await message.answer(f"❌ GPT tried to call non-existing <code>{func['name']}</code>", parse_mode="html")
+            return f"Function {func['name']} not found!", None
+    except Exception as e:
+        log.warn(f"Caught exception [bold]{type(e).__name__}[/] ({'. '.join(map(str, e.args))}) while trying to use [bold]{func['name']}[/]") 
+        log.exception()
+        return f"Failed to use function {func['name']}: {type(e).__name__} ({'. '.join(map(str, e.args))})", None
+
+
+def close_tool_calls(chat_id: int, content: str) -> None:
+    """Answers the tool calls of the last assistant message that have no result yet (the request was
+    interrupted), otherwise the API rejects the history"""
+    messages = db.get_messages(chat_id)
+    for i in reversed(range(len(messages))):
+        if messages[i].role == "assistant" and messages[i].get("tool_calls"):
+            answered = {m.get("tool_call_id") for m in messages[i + 1:]}
+            for call in messages[i]["tool_calls"]:
+                if call["id"] not in answered:
+                    db.create_message(chat_id, "tool", content=content, call_id=call["id"], function_name=call["function"]["name"])
+            return
+        if messages[i].role != "tool":
+            return
 
+
+class Generation:
+    """State of one request across its rounds: used tokens and time, sources and images collected by tools"""
+
+    def __init__(self, prompt: str, call_id: Optional[int] = None) -> None:
+        self.prompt = prompt
+        self.call_id = call_id if call_id is not None else randint(0, 65535)
+        self.start = datetime.now()
+        self.rounds = 0
+        self.tokens = 0
+        self.sources: List[str] = []
+        self.images: List[str] = []
+
+
+    @property
+    def elapsed(self) -> float:
+        return (datetime.now() - self.start).total_seconds()
+
+
+    def exceeded(self) -> Optional[str]:
+        """Which budget of the request is used up, if any"""
+        if self.rounds >= config.get("max_rounds", 8):
+            return f"{self.rounds} rounds"
+        if self.elapsed >= config.get("max_seconds", 300):
+            return f"{round(self.elapsed)}s"
+        if self.tokens >= config.get("max_request_tokens", 100000):
+            return f"{self.tokens} tokens"
+        return None
+
+
+async def request_completion(message: types.Message, model: str, messages: List[dict], context_tokens: int, final: bool) -> Tuple[dict, int, int, Optional[float], Optional[StreamWriter]]:
+    """One model call. Returns the message, total and completion tokens, time to first token and the stream writer"""
+    # The last round after a budget is exceeded has to answer with what it already has
+    tool_choice = {"tool_choice": "none"} if final else {}
+    if config.get("stream", False):
+        # The API does not report usage for streams, so tokens are estimated
+        writer = StreamWriter(message, config.get("stream_interval", 1.5))
+        msg, first_token = await stream_chat(writer.update, context_tokens + tools_tokens, model=model, messages=messages, max_tokens=2048, tools=functions, **tool_choice)
+        tokens_completion = message_tokens(msg) - 4
+        openai_tokens.inc(context_tokens, model=model, kind="prompt")
+        openai_tokens.inc(tokens_completion, model=model, kind="completion")
+        return msg, context_tokens + tokens_completion, tokens_completion, first_token, writer
+
+    response = await chat_completion(
+        context_tokens + tools_tokens,
+        model=model,
+        messages=messages,
+        max_tokens=2048,
+        tools=functions,
+        **tool_choice
+    )
+    tokens_total = response["usage"]["total_tokens"]
+    return response["choices"][0]["message"], tokens_total, tokens_total - response["usage"]["prompt_tokens"], None, None
+
+
+async def generate_result(message: types.Message, start_prompt: str, call_id: Optional[int] = None) -> int:
+    """Agent loop: asks the model, runs the tools it calls and asks again until it answers or a budget
+    (max_rounds, max_seconds, max_request_tokens) runs out. Returns the used tokens"""
+    user = db.get_user(message.chat.id)
+    chat_id = selected_chats[message.chat.id]
+    state = Generation(start_prompt, call_id)
+    log.info(f"Starting generation from [bold]{message.chat.full_name} ({message.chat.id})[/] with prompt [bold]{truncate_text(start_prompt)}[/] / [bold]0x{state.call_id:04x}[/] on [bold]{user.model}[/]")
+    with trace(state.call_id, truncate_text(start_prompt)) as root:
+        try:
+            final = False
+            while True:
+                state.rounds += 1
+                with span(f"completion #{state.rounds}") as completion:
+                    messages, context_tokens = await build_context(db.get_messages(chat_id), user.model)
+                    msg, tokens_total, tokens_completion, first_token, writer = await request_completion(message, user.model, messages, context_tokens, final)
+                state.tokens += tokens_total
+                ttft = f", first token after [bold]{first_token:.2f}s[/]" if first_token is not None else ""
+                log.info(f"Round [bold]#{state.rounds:02d}[/] for [bold]0x{state.call_id:04x}[/]: completion [bold]{completion.seconds:.2f}s[/] ([bold]{tokens_total}[/] tokens{ttft})")
+
+                if msg["content"]:
+                    with span("reply"):
+                        if writer is None:
+                            await message.delete()
+                        if tokens_completion == 0:
+                            await message.answer("📭 Model returned nothing (zero-length text)")
+                        elif writer is not None:
+                            await writer.finish(msg["content"])
+                        else:
+                            await send_html(message, await ato_html(msg["content"]), disable_web_page_preview=True)
+
+                        if len(state.images) > 0:
+                            # Images downloaded by the check are uploaded, Telegram fetches only the rest by url
+                            await message.answer_media_group([types.InputMediaPhoto(types.InputFile(BytesIO(data)) if (data := take_image(url)) else url)
+                                                              for url in state.images])
+                        if len(state.sources) > 0:
+                            await message.answer("<b>📜 Sources</b>\n" + \
+                                                "\n".join(map(lambda s: f"<a href='{s}'>{parse_domain(s)}</a>", state.sources)), 
+                                                parse_mode="html", disable_web_page_preview=True)            
+                    db.create_message(chat_id, "assistant", content=msg["content"], tokens=await compute.amessage_tokens({"role": "assistant", "content": msg["content"]}))
+                    break
+                elif msg["tool_calls"] and not final:
+                    calls = msg["tool_calls"]
+                    db.create_message(chat_id, "assistant", tool_calls=calls)
+                    # All calls of the turn run concurrently, results are stored in the original order
+                    semaphore = asyncio.Semaphore(config.get("tool_concurrency", 4))
+                    with span(f"tools #{state.rounds}") as tools:
+                        results = await asyncio.gather(*(run_tool(message, call, semaphore, state.sources) for call in calls))
+                    # Webpage analyses can be long, they are counted in the compute pool
+                    counts = await asyncio.gather(*(compute.amessage_tokens({"role": "tool", "content": content}) for content, _ in results))
+                    for call, (content, image), tokens in zip(calls, results, counts):
+                        if image is not None:
+                            state.images.append(image)
+                        db.create_message(chat_id, "tool", content=content, call_id=call["id"], function_name=call["function"]["name"], tokens=tokens)
+                    log.info(f"Round [bold]#{state.rounds:02d}[/] for [bold]0x{state.call_id:04x}[/]: {len(calls)} tools [bold]{tools.seconds:.2f}s[/]")
+
+                    if reason := state.exceeded():
+                        log.warn(f"Generation [bold]0x{state.call_id:04x}[/] is out of budget ({reason}), asking for the final answer")
+                        final = True
+                else:
+                    # Nothing was written yet, so the placeholder still says it is generating
+                    log.error(f"Empty message in round [bold]#{state.rounds:02d}[/] of [bold]0x{state.call_id:04x}[/]")
+                    await message.edit_text("📭 Model returned an empty message")
+                    break
+
+            spent = str(round(state.elapsed, 2))
+            log.success(f"Generation of [bold]{truncate_text(start_prompt)}[/] / [bold]0x{state.call_id:04x}[/] finished in [bold]{state.rounds}[/] rounds. Used [bold]{state.tokens}[/] tokens. Spent [bold]{spent}s[/]")
+            await message.answer( # TODO: bring price back
+                f"📊 Used tokens *{state.tokens}*\n" + \
+                f"⌛ Time spent *{escape(spent)}s*",
+                parse_mode="MarkdownV2")
+            return state.tokens
+
+        except asyncio.CancelledError:
+            log.warn(f"Generation [bold]0x{state.call_id:04x}[/] cancelled after [bold]{state.rounds}[/] rounds")
+            close_tool_calls(chat_id, "Cancelled by the user")
+            raise
+        except Exception as e:
+            log.error(f"Caught exception [bold]{type(e).__name__}[/] ({'. '.join(map(str, e.args))}) on line [bold]{e.__traceback__.tb_lineno}[/]")
+            log.exception()
+            close_tool_calls(chat_id, f"Failed: {type(e).__name__}")
+            await message.answer(f"❌ Error: `{type(e).__name__} ({'. '.join(map(str, e.args))})`", parse_mode="MarkdownV2")
+            return state.tokens
+        finally:
+            request_seconds.observe(root.seconds)
+            request_rounds.observe(state.rounds)
+
+
+async def update_title(chat_id: int, text: str) -> None:
+    try:
+        title = await create_title(text)
     except Exception as e:
-        log.error(f"Caught exception [bold]{type(e).__name__}[/] ({'. '.join(map(str, e.args))}) on line [bold]{e.__traceback__.tb_lineno}[/]")
-        log.console.print_exception()
-        await message.answer(f"❌ Error: `{type(e).__name__} ({'. '.join(map(str, e.args))})`", parse_mode="MarkdownV2")
+        log.warn(f"Could not generate a title for chat [bold]{chat_id}[/]: {type(e).__name__} ({e})")
+        return
+    db.set_title(chat_id, title)
+
+
+def new_chat(owner: int, text: Optional[str]) -> int:
+    """Creates a chat with the start of the message as a provisional title, the real one is generated in the background"""
+    chat = db.create_chat(truncate_text(text, 40) if text else "New chat", owner)
+    if system_message is not None:
+        db.create_message(chat.uid, "system", content=system_message)
+    if text:
+        task = asyncio.create_task(update_title(chat.uid, text))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return chat.uid
+
+
+async def answer_messages(messages: List[types.Message]) -> None:
+    """One turn for the messages of a user, several if they arrived while the previous turn was running"""
+    message = messages[-1]
+    current_user.set(message.from_id)
+    new = await message.answer("🧠 Starting generating...")
+    user = db.get_user(message.from_id)
+
+    for message in messages:
+        if len(message.photo) and user.model != "gpt-4-turbo":
+            await new.edit_text("❌ Images are not supported in this model")
+            return
+        if message.from_id not in selected_chats.keys():
+            selected_chats[message.from_id] = new_chat(message.from_id, message.text or message.caption)
+
+        if len(message.photo):
+            # Telegram sends every size of the photo, the last one is the largest
+            buffer = BytesIO()
+            await message.photo[-1].download(destination_file=buffer)
+            reference = await compute.run(blobs.put, buffer.getvalue())
+            db.create_message(selected_chats[message.from_id], "user", content=[{"type": "image_url", "image_url": {"url": reference}}])
+
+        db.create_message(selected_chats[message.from_id], "user", content = message.text or message.caption)
+    await generate_result(new, "\n".join(m.text or m.caption or "" for m in messages))
+
+
+queue: ChatQueue[types.Message] = ChatQueue(answer_messages, config.get("queue_policy", "coalesce"))
 
 
 @dp.message_handler(content_types=["text", "photo"])
@@ -355,33 +516,57 @@ async def on_message(message: types.Message):
     if not db.user_exists(message.from_id):
         db.create_user(message.from_id)
 
-    new = await message.answer("🧠 Starting generating...")
-    user = db.get_user(message)
+    if not queue.submit(message.from_id, message):
+        await message.reply("⏳ Still answering your previous message, try again when it's done")
 
-    if len(message.photo):
-        if user.model != "gpt-4-turbo":
-            await new.edit_text("❌ Images are not supported in this model")
-            return
-        for photo in message.photo:
-            buffer = BytesIO()
-            await photo.download(destination_file=buffer)
-            img_str = str(base64.b64encode(buffer.getvalue()), encoding="utf8")
-            if message.from_id not in selected_chats.keys():
-                selected_chats[message.from_id] = db.create_chat(await create_title(message.text or message.caption), message.from_id).uid
-            db.create_message(selected_chats[message.from_id], "user",
-                              content=[{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_str}"}}])  # TODO: improve code
-    
-    if message.from_id not in selected_chats.keys():
-        selected_chats[message.from_id] = db.create_chat(await create_title(message.text or message.caption), message.from_id).uid
-        if system_message is not None:
-            db.create_message(selected_chats[message.from_id], "system", content=system_message)
 
-    db.create_message(selected_chats[message.from_id], "user", content = message.text or message.caption)
-    await generate_result(new, message.text)
+async def on_startup(_: Dispatcher) -> None:
+    await start_session()
+    lag.start()
+    if config.get("metrics_port"):
+        await start_metrics(config.get("metrics_host", "127.0.0.1"), config["metrics_port"])
+
+
+async def on_shutdown(_: Dispatcher) -> None:
+    await stop_metrics()
+    lag.stop()
+    await close_session()
+    compute_executor.shutdown(wait=False)
+
+
+async def run_webhook() -> None:
+    """Serves updates over the webhook until SIGINT/SIGTERM, then finishes the queued updates and running turns.
+    The webhook stays registered, so Telegram keeps the updates sent during a restart"""
+    secret = config.get("webhook_secret")
+    server = WebhookServer(dp, secret, config.get("webhook_workers", 16), config.get("webhook_queue", 1000))
+    Gauge("webhook_queue_depth", "Updates waiting for a webhook worker", func=lambda: {(): server.queue.qsize()})
+    stop = asyncio.Event()
+    for signal in (SIGINT, SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signal, stop.set)
+
+    await on_startup(dp)
+    path = config.get("webhook_path", "/webhook")
+    await server.start(config.get("webhook_host", "127.0.0.1"), config.get("webhook_port", 8080), path)
+    if url := config.get("webhook_url"):
+        await bot.set_webhook(url + path, secret_token=secret)
+    await stop.wait()
+
+    log.info("Shutting down, finishing queued updates")
+    timeout = config.get("drain_timeout", 30)
+    await server.stop(timeout)
+    try:
+        await asyncio.wait_for(queue.join(), timeout)
+    except asyncio.TimeoutError:
+        log.warn(f"[bold]{len(queue.workers)}[/] turns were still running at shutdown")
+    await on_shutdown(dp)
+    await (await bot.get_session()).close()
 
 
 def main():
-    executor.start_polling(dp, skip_updates=True)
+    if config.get("mode", "polling") == "webhook":
+        asyncio.run(run_webhook())
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
 if __name__ == "__main__":
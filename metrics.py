@@ -0,0 +1,243 @@
+from aiogram import Bot
+from aiohttp import web
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from const import log
+
+
+def escape(value: str) -> str:
+    """Label value escaping of the Prometheus text format"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.append(self)
+
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+
+    def _format(self, key: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+    def samples(self) -> List[str]:
+        return []
+
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._format(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """Either set explicitly or read from `func` (returning {label values: value}) on every scrape"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), func: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None) -> None:
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.func = func
+
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+
+    def samples(self) -> List[str]:
+        values = self.func() if self.func is not None else self.values
+        return [f"{self.name}{self._format(key)} {value}" for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = latency_buckets) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}  # bucket counts, [sum]
+
+
+    def observe(self, value: float, **labels) -> None:
+        counts, total = self.values.setdefault(self._key(labels), ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._format(key, (('le', '+Inf' if bound == float('inf') else str(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format(key)} {total[0]}")
+            lines.append(f"{self.name}_count{self._format(key)} {cumulative}")
+        return lines
+
+
+registry: List[Metric] = []
+
+openai_seconds = Histogram("openai_request_seconds", "OpenAI request latency, streams until the first chunk", ("model",))
+openai_tokens = Counter("openai_tokens_total", "Tokens used by OpenAI requests", ("model", "kind"))
+service_calls = Counter("service_calls_total", "Calls to rate limited services", ("service",))
+service_retries = Counter("service_retries_total", "Retries of failed calls", ("service",))
+service_throttled = Counter("service_throttled_total", "Calls delayed by the rate limiter", ("service",))
+service_wait = Counter("service_wait_seconds_total", "Seconds spent waiting for the rate limiter and retries", ("service", "reason"))
+tool_seconds = Histogram("tool_seconds", "Tool call latency", ("function",))
+request_seconds = Histogram("request_seconds", "Wall time of a whole request (all rounds)", buckets=latency_buckets[6:])
+request_rounds = Histogram("request_rounds", "Model calls per request", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+db_write_seconds = Histogram("db_write_seconds", "Duration of persisting one database change", ("backend", "op"), (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+db_written_bytes = Counter("db_written_bytes_total", "Bytes written to the database files", ("backend",))
+telegram_seconds = Histogram("telegram_request_seconds", "Bot API request latency", ("method",))
+loop_lag = Histogram("event_loop_lag_seconds", "How late the event loop wakes up", buckets=latency_buckets[:9])
+
+
+class TimedBot(Bot):
+    """Bot that records the latency of every Bot API request"""
+
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None, **kwargs):
+        with telegram_seconds.time(method=method):
+            return await super().request(method, data, files, **kwargs)
+
+
+class Span:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.start = monotonic()
+        self.end: Optional[float] = None
+        self.children: List[Span] = []
+
+
+    @property
+    def seconds(self) -> float:
+        return (self.end or monotonic()) - self.start
+
+
+    def dump(self, depth: int = 0) -> str:
+        lines = [f"{'  ' * depth}{self.name}: {self.seconds:.3f}s{'' if self.end else ' (running)'}"]
+        # Children run concurrently in places (tools), so they are ordered by start
+        lines += [child.dump(depth + 1) for child in sorted(self.children, key=lambda s: s.start)]
+        return "\n".join(lines)
+
+
+# Span the current task works in, child tasks inherit it, so concurrent tools end up under their round
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+traces: OrderedDict[int, Span] = OrderedDict()  # call id -> root span, only the latest `max_traces`
+max_traces = 100
+
+
+@contextmanager
+def trace(call_id: int, name: str) -> Iterator[Span]:
+    """Root span of a request, kept in `traces` under its call id"""
+    root = Span(name)
+    traces[call_id] = root
+    while len(traces) > max_traces:
+        traces.popitem(last=False)
+    token = current_span.set(root)
+    try:
+        yield root
+    finally:
+        root.end = monotonic()
+        current_span.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[Span]:
+    """Child of the current span. Outside of a trace it only measures the time"""
+    parent = current_span.get()
+    child = Span(name)
+    if parent is not None:
+        parent.children.append(child)
+    token = current_span.set(child)
+    try:
+        yield child
+    finally:
+        child.end = monotonic()
+        current_span.reset(token)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+async def handle_metrics(_: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def handle_traces(request: web.Request) -> web.Response:
+    if "call_id" not in request.match_info:
+        return web.Response(text="\n".join(f"0x{call_id:04x} {root.name}: {root.seconds:.2f}s" for call_id, root in reversed(traces.items())))
+    try:
+        root = traces.get(int(request.match_info["call_id"], 16))
+    except ValueError:
+        root = None
+    if root is None:
+        return web.Response(status=404, text="Trace not found")
+    return web.Response(text=root.dump())
+
+
+runner: Optional[web.AppRunner] = None
+
+
+async def start_server(host: str, port: int) -> None:
+    """Serves /metrics (Prometheus text format), /traces (latest requests) and /traces/<call id> (span tree)"""
+    global runner
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/traces", handle_traces)
+    app.router.add_get("/traces/{call_id}", handle_traces)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f"Metrics are served on [bold]http://{host}:{port}/metrics[/]")
+
+
+async def stop_server() -> None:
+    global runner
+    if runner is not None:
+        await runner.cleanup()
+        runner = None
@@ -0,0 +1,187 @@
+import aiohttp
+import asyncio
+import openai
+
+from random import uniform
+from time import monotonic
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+from const import config, log
+from metrics import openai_seconds, openai_tokens, service_calls, service_retries, service_throttled, service_wait, span
+from scheduler import current_user, openai_limiter
+
+T = TypeVar("T")
+
+retryable_errors = (
+    openai.error.RateLimitError, openai.error.APIConnectionError, openai.error.ServiceUnavailableError,
+    openai.error.Timeout, openai.error.TryAgain, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError
+)
+retryable_statuses = (408, 429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """Allows `per_minute` units a minute with bursts up to the same amount. Waiting callers are served in order.
+    The rate is halved on every 429 and grows back by 5% per success, so it follows the real account limit"""
+
+    def __init__(self, per_minute: float) -> None:
+        self.limit = per_minute / 60
+        self.rate = self.limit
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = monotonic()
+        self.lock = asyncio.Lock()
+
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    async def take(self, amount: float) -> float:
+        """Waits until `amount` units are available and takes them. Returns the seconds waited"""
+        amount = min(amount, self.capacity)
+        start = monotonic()
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return monotonic() - start
+                await asyncio.sleep((amount - self.level) / self.rate)
+
+
+    def throttle(self) -> None:
+        self.rate = max(self.limit / 10, self.rate / 2)
+
+
+    def recover(self) -> None:
+        self.rate = min(self.limit, self.rate + self.limit / 20)
+
+
+class ModelLimit:
+    """Requests and tokens per minute of one model"""
+
+    def __init__(self, rpm: float, tpm: float) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+
+    async def take(self, tokens: int) -> float:
+        return await self.requests.take(1) + await self.tokens.take(tokens)
+
+
+    def throttle(self) -> None:
+        self.requests.throttle()
+        self.tokens.throttle()
+
+
+    def recover(self) -> None:
+        self.requests.recover()
+        self.tokens.recover()
+
+
+limits: Dict[str, ModelLimit] = {}
+
+
+def get_limit(model: str) -> Optional[ModelLimit]:
+    if model not in limits and model in config.get("rate_limits", {}):
+        limits[model] = ModelLimit(config["rate_limits"][model]["rpm"], config["rate_limits"][model]["tpm"])
+    return limits.get(model)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Delay the server asked for, if any"""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After") or headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in retryable_statuses
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status in retryable_statuses
+    return isinstance(error, retryable_errors)
+
+
+def is_throttled(error: Exception) -> bool:
+    return isinstance(error, openai.error.RateLimitError) or getattr(error, "status", None) == 429
+
+
+def check_status(response: aiohttp.ClientResponse) -> None:
+    """Raises on statuses worth retrying, other errors are left to the caller as before"""
+    if response.status in retryable_statuses:
+        raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                          message=response.reason or "", headers=response.headers)
+
+
+async def retry(name: str, func: Callable[[], Awaitable[T]], limit: Optional[ModelLimit] = None) -> T:
+    """Calls `func` until it succeeds, with jittered exponential backoff (or the server's Retry-After) between
+    transient failures. Gives up after `retry_attempts` tries and raises the last error"""
+    attempts = config.get("retry_attempts", 5)
+    backoff = config.get("retry_backoff", 1)
+    max_delay = config.get("retry_max_delay", 60)
+    service_calls.inc(service=name)
+    for attempt in range(1, attempts + 1):
+        try:
+            result = await func()
+        except Exception as e:
+            if attempt == attempts or not is_retryable(e):
+                raise
+            if limit is not None and is_throttled(e):
+                limit.throttle()
+            delay = retry_after(e) or uniform(0, min(max_delay, backoff * 2 ** (attempt - 1)))
+            log.warn(f"[bold]{name}[/] failed with [bold]{type(e).__name__}[/] ({e}), retry {attempt}/{attempts - 1} in [bold]{delay:.1f}s[/]")
+            service_retries.inc(service=name)
+            service_wait.inc(delay, service=name, reason="retry")
+            await asyncio.sleep(delay)
+        else:
+            if limit is not None:
+                limit.recover()
+            return result
+
+
+async def release_after(stream: AsyncIterator) -> AsyncIterator:
+    """Passes the stream through and frees its OpenAI slot once it is read (or closed)"""
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        openai_limiter.release()
+
+
+async def chat_completion(tokens: int, **kwargs):
+    """openai.ChatCompletion.acreate behind the model's rate limit and retries. `tokens` is the estimated prompt size,
+    max_tokens is added to it as the API counts it against the limit too. With stream=True only opening the stream is retried.
+    Every attempt takes its own slot of `openai_limiter`, so waiting for the rate limit or a retry doesn't hold one.
+    A stream keeps its slot until it is read, close it (contextlib.aclosing) if it may be abandoned"""
+    model = kwargs["model"]
+    user = current_user.get()
+
+    async def attempt():
+        await openai_limiter.acquire(user)
+        try:
+            response = await openai.ChatCompletion.acreate(**kwargs)
+        except BaseException:
+            openai_limiter.release()
+            raise
+        if kwargs.get("stream"):
+            return release_after(response)
+        openai_limiter.release()
+        return response
+
+    limit = get_limit(model)
+    if limit is not None:
+        waited = await limit.take(tokens + kwargs.get("max_tokens", 0))
+        if waited > 0.01:
+            service_throttled.inc(service=model)
+            service_wait.inc(waited, service=model, reason="throttle")
+            log.warn(f"Throttled [bold]{model}[/] request of ~{tokens} tokens for [bold]{waited:.1f}s[/]")
+    with span(f"openai {model}"), openai_seconds.time(model=model):
+        response = await retry(model, attempt, limit)
+    if not kwargs.get("stream"):
+        openai_tokens.inc(response["usage"]["prompt_tokens"], model=model, kind="prompt")
+        openai_tokens.inc(response["usage"]["total_tokens"] - response["usage"]["prompt_tokens"], model=model, kind="completion")
+    return response
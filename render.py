@@ -0,0 +1,169 @@
+import re
+
+from typing import List, Optional, Tuple
+
+inline_token = re.compile(r"""
+    (?P<escape>\\[\[\](){}<>\#*_+\-=\\|.!`])
+  | `(?P<code>[^`\n]+)`
+  | \[(?P<text>[^\]\n]*)\]\((?P<url>(?:[^()\s]|\([^()\s]*\))+)\)  # one level of parentheses, as in Wikipedia links
+  | (?P<star>\*{1,3})
+""", re.VERBOSE)
+fence = re.compile(r"^\s*```\s*([\w+#.-]*)\s*$")
+styles = {"*": ("<i>", "</i>"), "**": ("<b>", "</b>"), "***": ("<b><i>", "</i></b>")}
+
+
+def escape_html(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def render_inline(line: str) -> str:
+    """Bold/italic, inline code, links and backslash escapes of one line in a single scan.
+    Markers without a closing pair stay literal, so the result is always balanced"""
+    out: List[str] = []
+    opened: List[Tuple[str, int]] = []  # marker, index of its placeholder in out
+    pos = 0
+    for match in inline_token.finditer(line):
+        out.append(escape_html(line[pos:match.start()]))
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "escape":
+            out.append(escape_html(match.group(0)[1]))
+        elif kind == "code":
+            out.append(f"<code>{escape_html(match.group('code'))}</code>")
+        elif kind == "url":
+            url = escape_html(match.group("url")).replace("'", "&#39;")
+            out.append(f"<a href='{url}'>{render_inline(match.group('text'))}</a>")
+        elif opened and opened[-1][0] == match.group("star"):
+            marker, index = opened.pop()
+            out[index] = styles[marker][0]
+            out.append(styles[marker][1])
+        elif any(marker == match.group("star") for marker, _ in opened):
+            out.append(match.group("star"))  # would cross another style, keep it literal
+        else:
+            opened.append((match.group("star"), len(out)))
+            out.append(match.group("star"))
+    out.append(escape_html(line[pos:]))
+    return "".join(out)
+
+
+class Renderer:
+    """Markdown to Telegram HTML. Complete lines are rendered once and kept, so rendering a text
+    that only grew at the end (a streamed answer) costs only the new lines. Open blocks are closed in the output"""
+
+    def __init__(self) -> None:
+        self.reset()
+
+
+    def reset(self) -> None:
+        self.source = ""
+        self.html: List[str] = []
+        self.code: Optional[str] = None  # language of the open code block
+        self.code_lines = 0
+        self.quote = False
+        self.started = False
+
+
+    def _state(self) -> tuple:
+        return self.code, self.code_lines, self.quote, self.started
+
+
+    def _line(self, line: str) -> str:
+        sep = "\n" if self.started else ""
+        self.started = True
+        if self.code is not None:
+            if fence.match(line):
+                self.code = None
+                return "</code></pre>"
+            self.code_lines += 1
+            return ("\n" if self.code_lines > 1 else "") + escape_html(line)
+
+        prefix = ""
+        if self.quote and not line.startswith("> "):
+            self.quote = False
+            prefix = "</blockquote>"
+        if match := fence.match(line):
+            self.code = match.group(1)
+            self.code_lines = 0
+            attribute = f" class='language-{self.code}'" if self.code else ""
+            return f"{prefix}{sep}<pre><code{attribute}>"
+        if line.startswith("> "):
+            if self.quote:
+                return sep + render_inline(line[2:])
+            self.quote = True
+            return f"{prefix}{sep}<blockquote>{render_inline(line[2:])}"
+        return prefix + sep + render_inline(line)
+
+
+    def _closing(self) -> str:
+        if self.code is not None:
+            return "</code></pre>"
+        return "</blockquote>" if self.quote else ""
+
+
+    def render(self, text: str) -> str:
+        if not text.startswith(self.source):
+            self.reset()
+        end = text.rfind("\n") + 1
+        if end > len(self.source):
+            for line in text[len(self.source):end - 1].split("\n"):
+                self.html.append(self._line(line))
+            self.source = text[:end]
+
+        # The unfinished last line may still change, so it is rendered on a copy of the state
+        state = self._state()
+        tail = self._line(text[end:]) if end < len(text) else ""
+        closing = self._closing()
+        self.code, self.code_lines, self.quote, self.started = state
+        return "".join(self.html) + tail + closing
+
+
+html_atom = re.compile(r"<[^>]*>|&#?\w+;|\n|[^<&\n]+?(?=[\s<&]|$)[ \t]*|&")
+html_tag = re.compile(r"<[^>]*>")
+tag_name = re.compile(r"</?(\w+)")
+
+
+def split_html(html: str, limit: int = 3500) -> List[str]:
+    """Splits rendered HTML into messages of up to `limit` characters, preferably at line breaks and never
+    inside a tag or an entity. Tags open at a boundary are closed there and reopened in the next message"""
+    atoms = []
+    for atom in html_atom.findall(html):
+        # A single word longer than a message can only be cut
+        atoms += [atom[i:i + limit // 2] for i in range(0, len(atom), limit // 2)] if len(atom) > limit // 2 else [atom]
+
+    result = []
+    stack: List[Tuple[str, str]] = []  # name, opening tag
+    i = 0
+    while i < len(atoms):
+        parts = [tag for _, tag in stack]
+        size = sum(map(len, parts))
+        opened = list(stack)
+        line_break = None
+        j = i
+        while j < len(atoms):
+            atom = atoms[j]
+            after = list(opened)
+            if atom.startswith("</"):
+                name = tag_name.match(atom).group(1)
+                while after and after.pop()[0] != name:
+                    pass
+            elif atom.startswith("<") and not atom.endswith("/>"):
+                after.append((tag_name.match(atom).group(1), atom))
+            closing = sum(len(name) + 3 for name, _ in after)
+            if j > i and size + len(atom) + closing > limit:
+                break
+            parts.append(atom)
+            size += len(atom)
+            opened = after
+            j += 1
+            if atom == "\n":
+                line_break = (j, list(opened), len(parts))
+
+        if j < len(atoms) and line_break is not None:
+            j, opened, length = line_break
+            parts = parts[:length]
+        chunk = "".join(parts) + "".join(f"</{name}>" for name, _ in reversed(opened))
+        if html_tag.sub("", chunk).strip():
+            result.append(chunk)
+        stack = opened
+        i = j
+    return result
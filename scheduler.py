@@ -0,0 +1,131 @@
+import asyncio
+
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Deque, Dict, Generic, List, TypeVar
+
+from const import config, log
+
+T = TypeVar("T")
+
+# Telegram user the current task works for, inherited by the tasks it starts (tools, webpage parts)
+current_user: ContextVar[int] = ContextVar("current_user", default=0)
+
+
+class FairLimiter:
+    """Lets at most `limit` calls run at once. Waiting calls are granted round-robin by user,
+    so a user with many queued calls (a research-heavy turn) can't starve the others"""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
+        self.waiting: OrderedDict[int, Deque[asyncio.Future]] = OrderedDict()
+
+
+    @property
+    def queued(self) -> int:
+        return sum(map(len, self.waiting.values()))
+
+
+    async def acquire(self, user: int) -> None:
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(user, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # granted right before the cancellation, pass it on
+            elif user in self.waiting and future in self.waiting[user]:  # release() may have popped it already
+                self.waiting[user].remove(future)
+                if not self.waiting[user]:
+                    del self.waiting[user]
+            raise
+
+
+    def release(self) -> None:
+        while self.waiting:
+            user, futures = next(iter(self.waiting.items()))
+            future = futures.popleft()
+            if futures:
+                self.waiting.move_to_end(user)
+            else:
+                del self.waiting[user]
+            if not future.done():
+                future.set_result(None)  # the slot goes straight to the next user
+                return
+        self.active -= 1
+
+
+    @asynccontextmanager
+    async def slot(self, user: int = None):
+        await self.acquire(current_user.get() if user is None else user)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+openai_limiter = FairLimiter(config.get("openai_concurrency", 8))
+
+
+class ChatQueue(Generic[T]):
+    """Runs the handler for one key (user) at a time. What happens to items arriving meanwhile depends on `policy`:
+    "coalesce" - handled together in the next turn, "cancel" - the running turn is cancelled and they are handled
+    together right away, "reject" - dropped"""
+
+    def __init__(self, handler: Callable[[List[T]], Awaitable], policy: str = "coalesce") -> None:
+        if policy not in ("coalesce", "cancel", "reject"):
+            raise ValueError(f"Unknown queue policy {policy}")
+        self.handler = handler
+        self.policy = policy
+        self.pending: Dict[int, List[T]] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.current: Dict[int, asyncio.Task] = {}
+
+
+    @property
+    def depth(self) -> int:
+        return sum(map(len, self.pending.values()))
+
+
+    def submit(self, key: int, item: T) -> bool:
+        """Returns False if the item was rejected"""
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(self._work(key, [item]))
+            return True
+        if self.policy == "reject":
+            return False
+        # Pending items are kept by both policies, they reach the database only when they are handled
+        self.pending.setdefault(key, []).append(item)
+        if self.policy == "cancel" and key in self.current:
+            self.current[key].cancel()
+        return True
+
+
+    async def join(self) -> None:
+        """Waits until every running and pending turn is done"""
+        while self.workers:
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
+
+
+    async def _work(self, key: int, items: List[T]) -> None:
+        try:
+            while items:
+                self.current[key] = asyncio.create_task(self.handler(items))
+                try:
+                    await self.current[key]
+                except asyncio.CancelledError:
+                    if not self.current[key].cancelled():
+                        raise
+                    log.info(f"Turn of [bold]{key}[/] was cancelled by a newer message")
+                except Exception as e:
+                    log.error(f"Caught exception [bold]{type(e).__name__}[/] ({'. '.join(map(str, e.args))}) while handling messages of [bold]{key}[/]")
+                    log.exception()
+                items = self.pending.pop(key, [])
+        finally:
+            self.current.pop(key, None)
+            self.workers.pop(key, None)
@@ -0,0 +1,32 @@
+import aiohttp
+
+from typing import Optional
+
+from const import config, headers
+
+session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Application-wide HTTP client, connections are kept alive and reused by every tool"""
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=config.get("http_connections", 100),
+            limit_per_host=config.get("http_connections_per_host", 10),
+            ttl_dns_cache=300,
+            keepalive_timeout=30
+        )
+        session = aiohttp.ClientSession(connector=connector, headers=headers)
+    return session
+
+
+async def start_session(*_) -> None:
+    get_session()
+
+
+async def close_session(*_) -> None:
+    global session
+    if session is not None:
+        await session.close()
+        session = None
@@ -0,0 +1,126 @@
+import asyncio
+
+from aiogram import types
+from aiogram.utils.exceptions import CantParseEntities, RetryAfter, TelegramAPIError
+from contextlib import aclosing
+from datetime import datetime
+from html import unescape
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+from const import log
+from ratelimit import chat_completion
+from render import Renderer, html_tag, split_html
+
+
+async def stream_chat(on_content: Callable[[str], None], tokens: int, **kwargs) -> Tuple[dict, Optional[float]]:
+    """Runs a streamed ChatCompletion (`tokens` is the estimated prompt size) and assembles the deltas (text and tool_calls
+    fragments) into one message. `on_content` receives the whole text so far. Returns the message and the time to first token in seconds"""
+    start = datetime.now()
+    first_token = None
+    content = ""
+    tool_calls: Dict[int, dict] = {}
+    # Closed explicitly, so the OpenAI slot of the stream is freed even if reading it fails
+    async with aclosing(await chat_completion(tokens, stream=True, **kwargs)) as chunks:
+        async for chunk in chunks:
+            if len(chunk["choices"]) == 0:
+                continue
+            delta = chunk["choices"][0]["delta"]
+            if first_token is None:
+                first_token = (datetime.now() - start).total_seconds()
+
+            if delta.get("content"):
+                content += delta["content"]
+                on_content(content)
+            for part in delta.get("tool_calls") or []:
+                call = tool_calls.setdefault(part["index"], {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                if part.get("id"):
+                    call["id"] = part["id"]
+                if function := part.get("function"):
+                    call["function"]["name"] += function.get("name") or ""
+                    call["function"]["arguments"] += function.get("arguments") or ""
+
+    calls = [tool_calls[i] for i in sorted(tool_calls.keys())]
+    return {"role": "assistant", "content": content or None, "tool_calls": calls or None}, first_token
+
+
+async def send_html(message: types.Message, html: str, edit: bool = False, limit: int = 3500, **kwargs) -> List[types.Message]:
+    """Sends rendered HTML as balanced chunks (the first one replaces `message` if `edit` is set).
+    A chunk Telegram still refuses to parse is sent as plain text instead of losing the whole answer"""
+    sent = []
+    for i, chunk in enumerate(split_html(html, limit)):
+        send = message.edit_text if edit and i == 0 else message.answer
+        try:
+            sent.append(await send(chunk, parse_mode="html", **kwargs))
+        except CantParseEntities as e:
+            log.warn(f"Telegram could not parse chunk {i + 1} ({e}), sending it as plain text")
+            sent.append(await send(unescape(html_tag.sub("", chunk)), **kwargs))
+    return sent
+
+
+class StreamWriter:
+    """Mirrors a growing answer into Telegram. Edits the placeholder at most once per `interval` seconds
+    (Telegram throttles frequent edits) and continues in new messages once the text passes `limit` characters"""
+
+    def __init__(self, message: types.Message, interval: float = 1.5, limit: int = 3500) -> None:
+        self.messages = [message]
+        self.shown = [message.text]
+        self.interval = interval
+        self.limit = limit
+        self.next_update = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.renderer = Renderer()
+
+
+    def update(self, text: str) -> None:
+        # Never awaited by the stream reader, a slow edit is skipped instead of delaying the next delta
+        if monotonic() < self.next_update or (self.task and not self.task.done()):
+            return
+        self.next_update = monotonic() + self.interval
+        self.task = asyncio.create_task(self._try_render(text))
+
+
+    async def finish(self, text: str) -> None:
+        """Shows the whole answer. Unlike intermediate edits it must not fail on Telegram's parsing or flood limits"""
+        if self.task:
+            await self.task
+        await self._render(text, final=True)
+
+
+    async def _try_render(self, text: str) -> None:
+        try:
+            await self._render(text)
+        except RetryAfter as e:
+            self.next_update = monotonic() + e.timeout
+        except TelegramAPIError as e:
+            log.warn(f"Skipped streamed edit: [bold]{type(e).__name__}[/] ({e})")
+
+
+    async def _render(self, text: str, final: bool = False) -> None:
+        # Incremental, only the lines added since the previous edit are rendered
+        for i, chunk in enumerate(split_html(self.renderer.render(text), self.limit)):
+            if i == len(self.messages):
+                self.messages.append(await self._send(self.messages[-1].answer, chunk, final))
+                self.shown.append(chunk)
+            elif self.shown[i] != chunk:
+                await self._send(self.messages[i].edit_text, chunk, final)
+                self.shown[i] = chunk
+
+
+    async def _send(self, send: Callable, chunk: str, final: bool, attempts: int = 3) -> types.Message:
+        """Sends or edits one chunk. For the final text a chunk Telegram can't parse goes as plain text (as in send_html)
+        and flood limits are waited out"""
+        for attempt in range(1, attempts + 1):
+            try:
+                try:
+                    return await send(chunk, parse_mode="html", disable_web_page_preview=True)
+                except CantParseEntities as e:
+                    if not final:
+                        raise
+                    log.warn(f"Telegram could not parse the streamed chunk ({e}), sending it as plain text")
+                    return await send(unescape(html_tag.sub("", chunk)), disable_web_page_preview=True)
+            except RetryAfter as e:
+                if not final or attempt == attempts:
+                    raise
+                log.warn(f"Telegram asked to wait [bold]{e.timeout}s[/] before the final streamed edit")
+                await asyncio.sleep(e.timeout)
@@ -1,20 +1,27 @@
-import aiohttp
+import asyncio
 import imghdr
 import re
-import openai
 import os
 import tiktoken
 
+from collections import OrderedDict, deque
 from io import BytesIO
 from random import randint
-from typing import List, Iterable
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple
 
-from const import headers, log
+from const import config, log
+from extract import read_body
+from ratelimit import chat_completion
+from render import Renderer
+from session import get_session
 
 os.environ["TIKTOKEN_CACHE_DIR"] = "tiktoken_cache/"
 
 escaped = ["[", "]", "(", ")", ">", "#", "+", "-", "=", "|", "{", "}", ".", "!"]
 encoding = tiktoken.get_encoding("cl100k_base")
+sentence_end = re.compile(r"(?<=[.!?])\s+")
+# url -> body of images checked by add_image, least recently verified first, bounded by `image_cache_bytes`
+verified_images: OrderedDict[str, bytes] = OrderedDict()
 
 
 def truncate_text(text, limit=50):
@@ -28,23 +35,7 @@ def chunks(lst: list, n: int) -> list:
 
 
 def to_html(markdown_text: str) -> str:
-    html_text = markdown_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-    html_text = re.sub(r"\*\*\*(.*?)\*\*\*", r"<b><i>\1</i></b>", html_text)  # bold and italic sim.
-    html_text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", html_text)  # bold
-    html_text = re.sub(r"\*(.*?)\*", r"<i>\1</i>", html_text)  # italic
-    
-    def replace_code_blocks(match):
-        language = match.group(1) or ""
-        code = match.group(2)
-        return f"<pre><code class='language-{language}'>{code}</code></pre>"    
-    html_text = re.sub(r"```(\w+)?\n(.*?)\n```", replace_code_blocks, html_text, flags=re.DOTALL)  # code block
-    
-    html_text = re.sub(r"`(.*?)`", r"<code>\1</code>", html_text)  # inline code
-
-    html_text = re.sub(r"^> (.*?)$", r"<blockquote>\1</blockquote>", html_text, flags=re.MULTILINE)  # quote
-    #html_text = re.sub(r"!\[(.*?)\]\((.*?)\)", r"<img src="\2" alt="\1">", html_text)
-    html_text = re.sub(r"\[(.*?)\]\((.*?)\)", r"<a href='\2'>\1</a>", html_text)  # link
-    return unescape(html_text)
+    return Renderer().render(markdown_text)
 
 
 def escape(string: str, formatting=False) -> str:
@@ -60,28 +51,9 @@ def escape(string: str, formatting=False) -> str:
     return string
 
 
-import re
-
-def unescape(text):
-    escaped_characters = {
-        r"\[": "[", r"\]": "]",
-        r"\(": "(", r"\)": ")",
-        r"\{": "{", r"\}": "}",
-        r"\<": "<", r"\>": ">",
-        r"\#": "#", r"\*": "*", r"\_": "_", 
-        r"\+": "+", r"\-": "-", r"\=": "=",
-        r"\\": "\\", r"\|": "|",
-        r"\.": ".", r"\!": "!",
-    }
-
-    for escaped, unescaped in escaped_characters.items():
-        text = text.replace(escaped, unescaped)
-
-    return text
-
-
 async def create_title(message: str) -> str:
-    response = await openai.ChatCompletion.acreate(
+    response = await chat_completion(
+        total_tokens(message) + 64,
         model="gpt-3.5-turbo",
         messages=[{
             "role": "system",
@@ -125,17 +97,100 @@ def total_tokens(text: str) -> int:
     return len(tokenize(text))
 
 
-def split_text(text: str, size: int = 10000) -> List[str]:
-    return list(map(detokenize, chunks(tokenize(text), size)))
+def message_tokens(message: dict) -> int:
+    """Approximate prompt size of one chat message: text and image parts, tool calls and a few tokens of overhead"""
+    tokens = 4
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += total_tokens(content)
+    elif content:
+        for part in content:
+            if part.get("type") == "text":
+                tokens += total_tokens(part["text"])
+            elif part.get("type") == "image_url":
+                # Vision: 85 tokens + 170 per 512px tile, a photo scaled down to 768px usually takes 4 tiles
+                tokens += 85 if part["image_url"].get("detail") == "low" else 765
+    for call in message.get("tool_calls") or []:
+        tokens += total_tokens(call["function"]["name"] + call["function"]["arguments"])
+    return tokens
+
+
+def text_units(text: str, size: int) -> Iterator[Tuple[str, int]]:
+    """Paragraphs of the text with their token counts. Paragraphs longer than `size` are split into sentences,
+    then into words, and only a single huge word is cut by tokens"""
+    for paragraph in re.finditer(r"[^\n]+", text):
+        paragraph = paragraph.group(0)
+        if (count := total_tokens(paragraph) + 1) <= size:
+            yield paragraph + "\n", count
+            continue
+        for sentence in sentence_end.split(paragraph):
+            if (count := total_tokens(sentence) + 1) <= size:
+                yield sentence + " ", count
+                continue
+            for word in sentence.split(" "):
+                tokens = tokenize(word + " ")
+                for part in chunks(tokens, size):
+                    yield detokenize(part), len(part)
+
+
+def iter_split_text(text: str, size: int = 10000, overlap: int = 0) -> Iterator[str]:
+    """Lazily splits the text into parts of up to `size` tokens on paragraph/sentence boundaries.
+    Each part repeats up to `overlap` tokens of the previous one. Only one unit is tokenized at a time"""
+    units: Deque[Tuple[str, int]] = deque()
+    count = 0
+    fresh = False
+    for unit, unit_count in text_units(text, size):
+        if count + unit_count > size and fresh:
+            yield "".join(u for u, _ in units).strip()
+            fresh = False
+            while units and (count > overlap or count + unit_count > size):
+                count -= units.popleft()[1]
+        units.append((unit, unit_count))
+        count += unit_count
+        fresh = True
+    if fresh:
+        yield "".join(u for u, _ in units).strip()
+
+
+def split_text(text: str, size: int = 10000, overlap: int = 0) -> List[str]:
+    return list(iter_split_text(text, size, overlap))
+
+
+def remember_image(url: str, data: bytes) -> None:
+    verified_images[url] = data
+    verified_images.move_to_end(url)
+    while sum(map(len, verified_images.values())) > config.get("image_cache_bytes", 32 * 2**20) and len(verified_images) > 0:
+        verified_images.popitem(last=False)
+
+
+def take_image(url: str) -> Optional[bytes]:
+    """Downloaded body of a verified image, if it is still cached"""
+    return verified_images.pop(url, None)
 
 
 async def verify_image(url: str, types: Iterable[str]) -> bool:
+    """Checks the type by the first bytes of the response, images larger than `image_max_bytes` are rejected
+    by Content-Length before reading anything. The body of a valid image is kept for the upload (see take_image)"""
+    max_bytes = config.get("image_max_bytes", 5 * 2**20)
     try:
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(url) as response:
-                t = imghdr.what(None, h=await response.read()).lower()
-                return t in types
+        async with get_session().get(url) as response:
+            if response.status != 200 or (response.content_length or 0) > max_bytes:
+                log.warn(f"Image [bold]{url}[/] returned status {response.status}, {response.content_length} bytes")
+                return False
+            try:
+                head = await response.content.readexactly(32)
+            except asyncio.IncompleteReadError as e:
+                head = e.partial
+            kind = imghdr.what(None, h=head)
+            if kind is None or kind.lower() not in types:
+                return False
+            if config.get("image_cache_bytes", 32 * 2**20) > 0:
+                body = head + await read_body(response, max_bytes + 1 - len(head))
+                if len(body) > max_bytes:
+                    return False
+                remember_image(url, body)
+            return True
     except Exception:
         log.warn(f"Unable to determine filetype of [bold]{url}[/]")
-        log.console.print_exception()
+        log.exception()
         return False
@@ -0,0 +1,115 @@
+import aiohttp
+import asyncio
+import hmac
+import json
+import sys
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from itertools import count
+from time import time
+from typing import List, Optional
+
+from const import log
+
+# Usage: python webhook.py <url> <secret or -> [updates] [users] - posts fake text messages like Telegram does
+
+
+class WebhookServer:
+    """Receives updates from Telegram over HTTP. Every update is acknowledged with 200 as soon as it is queued,
+    `workers` tasks feed the queue to the dispatcher. A full queue is answered with 503, so Telegram redelivers it later"""
+
+    def __init__(self, dp: Dispatcher, secret: Optional[str] = None, workers: int = 16, queue_size: int = 1000) -> None:
+        self.dp = dp
+        self.secret = secret
+        self.workers = workers
+        self.queue: asyncio.Queue[types.Update] = asyncio.Queue(queue_size)
+        self.tasks: List[asyncio.Task] = []
+        self.runner: Optional[web.AppRunner] = None
+
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret is not None and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret):
+            log.warn(f"Rejected a webhook request from [bold]{request.remote}[/] with a wrong secret token")
+            return web.Response(status=401)
+        try:
+            update = types.Update(**await request.json())
+        except (json.JSONDecodeError, TypeError):
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            log.warn(f"Webhook queue is full ([bold]{self.queue.qsize()}[/] updates), update {update.update_id} refused")
+            return web.Response(status=503)
+        return web.Response()
+
+
+    async def _work(self) -> None:
+        # Handlers use Bot.get_current() and Dispatcher.get_current(), the context is not inherited from the request
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.process_update(update)
+            except Exception as e:
+                log.error(f"Caught exception [bold]{type(e).__name__}[/] ({'. '.join(map(str, e.args))}) while processing update {update.update_id}")
+                log.exception()
+            finally:
+                self.queue.task_done()
+
+
+    async def start(self, host: str, port: int, path: str) -> None:
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        log.success(f"Listening for updates on [bold]http://{host}:{port}{path}[/]")
+
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Stops accepting updates and waits up to `timeout` seconds for the queued ones to be handled"""
+        await self.runner.shutdown()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warn(f"[bold]{self.queue.qsize()}[/] updates were not handled before shutdown")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.runner.cleanup()
+
+
+def fake_update(update_id: int, user: int, text: str) -> dict:
+    sender = {"id": user, "is_bot": False, "first_name": f"User {user}"}
+    chat = {"id": user, "type": "private", "first_name": f"User {user}"}
+    return {"update_id": update_id, "message": {"message_id": update_id, "from": sender, "chat": chat, "date": int(time()), "text": text}}
+
+
+async def post_updates(url: str, secret: Optional[str], updates: List[dict]) -> List[int]:
+    """Posts updates the way Telegram does (concurrently, with the secret header) and returns the status codes"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    async with aiohttp.ClientSession(headers=headers) as session:
+
+        async def post(update: dict) -> int:
+            async with session.post(url, json=update) as response:
+                return response.status
+
+        return await asyncio.gather(*map(post, updates))
+
+
+async def main(url: str, secret: str, updates: str = "10", users: str = "1") -> None:
+    ids = count(1)
+    batch = [fake_update(next(ids), 1 + i % int(users), f"Test message #{i}") for i in range(int(updates))]
+    start = time()
+    statuses = await post_updates(url, None if secret == "-" else secret, batch)
+    print(f"{len(batch)} updates in {time() - start:.2f}s: " + ", ".join(f"{statuses.count(s)}x {s}" for s in sorted(set(statuses))))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python webhook.py <url> <secret or -> [updates] [users]")
+        sys.exit(1)
+    asyncio.run(main(*sys.argv[1:]))